@@ -16,7 +16,9 @@
 
 """Cluster management daemon for the Google HPC Toolkit Frontend"""
 
+import collections
 import grp
+import hashlib
 import json
 import logging.handlers
 import os
@@ -25,6 +27,7 @@ import shutil
 import socket
 import subprocess
 import sys
+import threading
 import time
 import concurrent.futures
 from functools import wraps
@@ -32,8 +35,10 @@ from pathlib import Path
 from urllib.parse import urlparse
 
 import pexpect
+import prometheus_client
 import requests
 import yaml
+from google.api_core import exceptions as gapi_exceptions
 from google.cloud import pubsub
 from google.cloud import storage as gcs
 
@@ -69,21 +74,141 @@ cluster_bucket = config["cluster_bucket"]
 spack_path = config.get("spack_path", "/opt/cluster/spack")
 spack_bin = f"{spack_path}/bin/spack"
 
-pubClient = pubsub.PublisherClient()
 subscriber = pubsub.SubscriberClient()
-thread_pool = concurrent.futures.ThreadPoolExecutor()
+_gcs_client = None
+_gcs_client_lock = threading.Lock()
 
 _c2_ackMap = {}
 
 
+def get_gcs_client():
+    """Returns the daemon's shared GCS client"""
+    global _gcs_client
+    with _gcs_client_lock:
+        if not _gcs_client:
+            _gcs_client = gcs.Client()
+        return _gcs_client
+
+
+_METRIC_PUBLISHED = prometheus_client.Counter(
+    "ghpcfe_c2_messages_published",
+    "Messages successfully published to the frontend",
+    ["command"],
+)
+_METRIC_PUBLISH_RETRIED = prometheus_client.Counter(
+    "ghpcfe_c2_messages_publish_retried",
+    "Message publishes retried after a failure",
+    ["command"],
+)
+_METRIC_PUBLISH_FAILED = prometheus_client.Counter(
+    "ghpcfe_c2_messages_publish_failed",
+    "Messages dropped after exhausting publish retries",
+    ["command"],
+)
+_METRIC_PUBLISH_LATENCY = prometheus_client.Histogram(
+    "ghpcfe_c2_message_publish_seconds",
+    "Time from publishing a message to its delivery to pubsub",
+    ["command"],
+)
+
+
+class Publisher:
+    """Batching, flow-controlled pubsub publisher with delivery tracking
+
+    Messages are batched according to `batch` (max_messages, max_bytes,
+    max_latency), and publishing blocks once more than `flow_control`
+    (message_limit, byte_limit) messages are outstanding.  Each delivery
+    future is tracked: failed publishes are retried, with backoff, up to
+    `retries` times before the message is dropped and logged.
+    """
+
+    def __init__(self, topic_path, batch=None, flow_control=None, retries=3):
+        batch = batch if batch else {}
+        flow_control = flow_control if flow_control else {}
+        self._topic_path = topic_path
+        self._retries = retries
+        self._client = pubsub.PublisherClient(
+            batch_settings=pubsub.types.BatchSettings(
+                max_messages=batch.get("max_messages", 100),
+                max_bytes=batch.get("max_bytes", 1024 * 1024),
+                max_latency=batch.get("max_latency", 0.05),
+            ),
+            publisher_options=pubsub.types.PublisherOptions(
+                flow_control=pubsub.types.PublishFlowControl(
+                    message_limit=flow_control.get("message_limit", 1000),
+                    byte_limit=flow_control.get("byte_limit", 10 * 1024 * 1024),
+                    limit_exceeded_behavior=(
+                        pubsub.types.LimitExceededBehavior.BLOCK
+                    ),
+                ),
+            ),
+        )
+
+    def publish(self, data, attempt=0, **attrs):
+        """Publish a message, returning its delivery future"""
+        start = time.monotonic()
+        future = self._client.publish(self._topic_path, data, **attrs)
+        future.add_done_callback(
+            lambda f: self._on_done(f, start, data, attempt, attrs)
+        )
+        return future
+
+    def _on_done(self, future, start, data, attempt, attrs):
+        command = attrs.get("command", "")
+        try:
+            future.result()
+        except Exception as err:
+            if attempt < self._retries:
+                _METRIC_PUBLISH_RETRIED.labels(command=command).inc()
+                logger.warning(
+                    "Failed to publish %s message (attempt %d), retrying: %s",
+                    command,
+                    attempt + 1,
+                    err,
+                )
+                threading.Timer(
+                    2**attempt,
+                    self.publish,
+                    args=(data, attempt + 1),
+                    kwargs=attrs,
+                ).start()
+            else:
+                _METRIC_PUBLISH_FAILED.labels(command=command).inc()
+                logger.error(
+                    "Dropping %s message after %d failed publishes",
+                    command,
+                    attempt + 1,
+                    exc_info=err,
+                )
+            return
+        _METRIC_PUBLISHED.labels(command=command).inc()
+        _METRIC_PUBLISH_LATENCY.labels(command=command).observe(
+            time.monotonic() - start
+        )
+
+    def stop(self):
+        """Flush any pending messages, and stop publishing"""
+        self._client.stop()
+
+
+publisher = Publisher(
+    config["topic_path"],
+    batch=config.get("publish_batch", None),
+    flow_control=config.get("publish_flow_control", None),
+    retries=config.get("publish_retries", 3),
+)
+
+
 def send_message(command, message, extra_attrs=None):
-    """Send message to frontend via pubsub"""
+    """Send message to frontend via pubsub
+
+    Returns the delivery future of the message.
+    """
 
     extra_attrs = extra_attrs if extra_attrs else {}
     # We always want our ID in the message
     message["cluster_id"] = config["cluster_id"]
-    pubClient.publish(
-        config["topic_path"],
+    return publisher.publish(
         bytes(json.dumps(message), "utf-8"),
         command=command,
         source=source_id,
@@ -91,29 +216,173 @@ def send_message(command, message, extra_attrs=None):
     )
 
 
-def cb_in_thread(func):
-    """Decorator wrapper to run callbacks in async threads"""
+# Default number of worker threads for each command type.  Commands that
+# are not listed here are run directly on the pubsub callback thread.
+_DEFAULT_WORKER_LIMITS = {
+    "RUN_JOB": 32,
+    "SPACK_INSTALL": 4,
+    "INSTALL_APPLICATION": 4,
+    "SYNC": 1,
+    "REGISTER_USER_GCS": 4,
+}
 
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        logger.debug("Spawning Callback in threadpool")
-        fut = thread_pool.submit(func, *args, **kwargs)
-        try:
-            logger.warning(
-                "Job had quick exception", exc_info=fut.exception(timeout=0.5)
+_METRIC_QUEUED = prometheus_client.Gauge(
+    "ghpcfe_c2_commands_queued",
+    "Commands waiting for a worker thread",
+    ["command"],
+)
+_METRIC_RUNNING = prometheus_client.Gauge(
+    "ghpcfe_c2_commands_running",
+    "Commands currently being handled",
+    ["command"],
+)
+_METRIC_REJECTED = prometheus_client.Counter(
+    "ghpcfe_c2_commands_rejected",
+    "Commands returned to pubsub because their queue was full",
+    ["command"],
+)
+_METRIC_FAILED = prometheus_client.Counter(
+    "ghpcfe_c2_commands_failed",
+    "Commands whose handler raised an exception",
+    ["command"],
+)
+_METRIC_QUEUE_LATENCY = prometheus_client.Histogram(
+    "ghpcfe_c2_command_queue_seconds",
+    "Time commands spend waiting for a worker thread",
+    ["command"],
+)
+_METRIC_DURATION = prometheus_client.Histogram(
+    "ghpcfe_c2_command_duration_seconds",
+    "Time taken to handle commands",
+    ["command"],
+    buckets=(1, 10, 60, 300, 900, 3600, 4 * 3600, 24 * 3600, float("inf")),
+)
+
+
+class CommandScheduler:
+    """Bounded, per-command worker pools for long-running command handlers
+
+    Each command type gets its own named executor, so that (for instance)
+    a burst of job submissions cannot hold up syncs or installs, and the
+    pubsub callback threads stay free for PING/ACK/UPDATE handling.  When
+    more than `max_queued` commands of one type are waiting for a worker,
+    further messages are refused so that pubsub redelivers them later.
+    """
+
+    def __init__(self, limits, max_queued):
+        self._limits = limits
+        self._max_queued = max_queued
+        self._lock = threading.Lock()
+        self._executors = {}
+        self._queued = collections.Counter()
+
+    def _get_executor(self, command):
+        if command not in self._executors:
+            self._executors[command] = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self._limits.get(command, 1),
+                thread_name_prefix=command.lower(),
+            )
+        return self._executors[command]
+
+    def submit(self, command, func, *args, **kwargs):
+        """Queue `func` on the pool for `command`
+
+        Returns False, without queueing, if that pool's queue is full.
+        """
+        with self._lock:
+            if self._queued[command] >= self._max_queued:
+                _METRIC_REJECTED.labels(command).inc()
+                return False
+            self._queued[command] += 1
+            executor = self._get_executor(command)
+        _METRIC_QUEUED.labels(command).inc()
+        queued_at = time.monotonic()
+
+        def run():
+            with self._lock:
+                self._queued[command] -= 1
+            started_at = time.monotonic()
+            _METRIC_QUEUED.labels(command).dec()
+            _METRIC_QUEUE_LATENCY.labels(command).observe(
+                started_at - queued_at
             )
-        except concurrent.futures.TimeoutError:
-            # Job is still going - good.
-            pass
+            _METRIC_RUNNING.labels(command).inc()
+            try:
+                func(*args, **kwargs)
+            except Exception as err:
+                _METRIC_FAILED.labels(command).inc()
+                logger.error("%s handler threw an error", command, exc_info=err)
+            finally:
+                _METRIC_RUNNING.labels(command).dec()
+                _METRIC_DURATION.labels(command).observe(
+                    time.monotonic() - started_at
+                )
+
+        executor.submit(run)
+        return True
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executors = list(self._executors.values())
+        for executor in executors:
+            executor.shutdown(wait=wait)
+
 
-    return wrapper
+scheduler = CommandScheduler(
+    {**_DEFAULT_WORKER_LIMITS, **config.get("worker_limits", {})},
+    config.get("max_queued_commands", 100),
+)
+
+
+def cb_in_thread(command):
+    """Decorator wrapper to run callbacks in the `command` worker pool"""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            logger.debug("Queueing %s callback in worker pool", command)
+            if not scheduler.submit(command, func, *args, **kwargs):
+                logger.warning(
+                    "Too many %s commands queued, deferring message", command
+                )
+                return False
+            return True
+
+        return wrapper
+
+    return decorator
 
 
 def _download_gcs_directory(blob_path: str, target_dir: Path) -> None:
-    client = gcs.Client()
+    """Incrementally sync a GCS 'directory' to `target_dir`
+
+    A manifest of the generation and MD5 of each downloaded object is kept
+    in `target_dir`.  Only objects which have changed since the last sync
+    are downloaded (concurrently), and local copies of objects which have
+    since been removed from GCS are deleted.
+    """
+    manifest_file = target_dir / ".gcs_manifest.json"
+    try:
+        manifest = json.loads(manifest_file.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        manifest = {}
+
+    client = get_gcs_client()
     gcs_bucket = client.bucket(cluster_bucket)
+    new_manifest = {}
+    changed = []
     for blob in client.list_blobs(gcs_bucket, prefix=blob_path):
-        local_filename = target_dir / blob.name[len(blob_path) + 1 :]
+        name = blob.name[len(blob_path) + 1 :]
+        if not name or name.endswith("/"):
+            continue
+        entry = {"generation": blob.generation, "md5": blob.md5_hash}
+        new_manifest[name] = entry
+        local_filename = target_dir / name
+        if manifest.get(name, None) != entry or not local_filename.exists():
+            changed.append((blob, local_filename))
+
+    def download(item):
+        (blob, local_filename) = item
         logger.debug(
             "Attempting to download %s from %s to %s",
             blob.name,
@@ -123,6 +392,28 @@ def _download_gcs_directory(blob_path: str, target_dir: Path) -> None:
         local_filename.parent.mkdir(parents=True, exist_ok=True)
         blob.download_to_filename(local_filename.as_posix())
 
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=config.get("gcs_download_workers", 8),
+        thread_name_prefix="gcs-download",
+    ) as pool:
+        # Consume the results so that any download error is raised
+        list(pool.map(download, changed))
+
+    removed = manifest.keys() - new_manifest.keys()
+    for name in removed:
+        logger.debug("Removing %s, deleted from %s", name, cluster_bucket)
+        (target_dir / name).unlink(missing_ok=True)
+
+    target_dir.mkdir(parents=True, exist_ok=True)
+    manifest_file.write_text(json.dumps(new_manifest), encoding="utf-8")
+    logger.info(
+        "Synced %s: %d objects downloaded, %d removed, %d unchanged",
+        blob_path,
+        len(changed),
+        len(removed),
+        len(new_manifest) - len(changed),
+    )
+
 
 def _rerun_ansible():
     # Download ansible repo from GCS  (Can't just point at it)
@@ -156,7 +447,7 @@ def _rerun_ansible():
 # Action functions
 
 
-# @cb_in_thread
+@cb_in_thread("SYNC")
 def cb_sync(message):
     """Callback for handling cluster syncs"""
 
@@ -197,57 +488,414 @@ def cb_sync(message):
 
 
 def _upload_log_blobs(log_dict):
-    client = gcs.Client()
-    gcs_bucket = client.bucket(cluster_bucket)
+    gcs_bucket = get_gcs_client().bucket(cluster_bucket)
     for path, data in log_dict.items():
-        if data:
+        if not data:
             continue
 
         # cluster_bucket is bucket and path...
         full_path = f"clusters/{config['cluster_id']}/{path}"
         blob = gcs_bucket.blob(full_path)
         blob.upload_from_string(data)
-    client.close()
 
 
-def _upload_log_files(log_dict):
-    client = gcs.Client()
-    gcs_bucket = client.bucket(cluster_bucket)
-    for path, filename in log_dict.items():
-        if not Path(filename).exists():
-            continue
+class LogShipper:
+    """Append-only shipping of growing log files to GCS
 
-        # cluster_bucket is bucket and path...
-        full_path = f"clusters/{config['cluster_id']}/{path}"
+    The byte offset shipped so far is tracked for each log file.  Only data
+    appended since the last upload is sent, as a temporary object which is
+    then composed onto the end of the existing GCS object, so the Frontend
+    still sees a single object holding the whole log.  If the file has been
+    rotated, truncated or rewritten, or the GCS object has changed underneath
+    us, the whole file is uploaded again.  A file reopened for writing keeps
+    its inode and may grow past the old offset, so rewrites are spotted by
+    a digest of the first and last blocks already shipped.  Offsets are
+    persisted to `state_file` so that they survive daemon restarts.
+    """
+
+    MAX_TRACKED_FILES = 1024
+    DIGEST_BLOCK_SIZE = 4096
+
+    def __init__(self, state_file):
+        self._lock = threading.Lock()
+        self._state_file = Path(state_file)
+        try:
+            self._state = collections.OrderedDict(
+                json.loads(self._state_file.read_text(encoding="utf-8"))
+            )
+        except (OSError, ValueError):
+            self._state = collections.OrderedDict()
+
+    def ship(self, log_dict):
+        """Upload new data from each {gcs path: local filename} in log_dict"""
+        gcs_bucket = get_gcs_client().bucket(cluster_bucket)
+        with self._lock:
+            try:
+                for path, filename in log_dict.items():
+                    if not Path(filename).exists():
+                        continue
+
+                    # cluster_bucket is bucket and path...
+                    full_path = f"clusters/{config['cluster_id']}/{path}"
+                    self._ship_file(gcs_bucket, full_path, filename)
+            finally:
+                while len(self._state) > self.MAX_TRACKED_FILES:
+                    self._state.popitem(last=False)
+                self._save_state()
+
+    @classmethod
+    def _digest(cls, filename, offset):
+        """Digest of the first and last blocks of a file, up to offset"""
+        digest = hashlib.sha256()
+        with open(filename, "rb") as fileh:
+            digest.update(fileh.read(min(offset, cls.DIGEST_BLOCK_SIZE)))
+            tail = max(offset - cls.DIGEST_BLOCK_SIZE, 0)
+            fileh.seek(tail)
+            digest.update(fileh.read(offset - tail))
+        return digest.hexdigest()
+
+    def _ship_file(self, gcs_bucket, full_path, filename):
+        stat = os.stat(filename)
+        prev = self._state.pop(full_path, None)
+        try:
+            self._state[full_path] = self._upload(
+                gcs_bucket, full_path, filename, stat, prev
+            )
+        except Exception:
+            # Retry from where we were, next time
+            if prev:
+                self._state[full_path] = prev
+            raise
+
+    def _upload(self, gcs_bucket, full_path, filename, stat, prev):
+        """Ship the file, returning its new state"""
         blob = gcs_bucket.blob(full_path)
-        blob.upload_from_filename(filename)
-    client.close()
 
+        if (
+            prev
+            and prev["inode"] == stat.st_ino
+            and prev["offset"] <= stat.st_size
+            and prev.get("digest") == self._digest(filename, prev["offset"])
+        ):
+            if prev["offset"] == stat.st_size:
+                return prev
+            try:
+                self._append(gcs_bucket, blob, filename, prev, stat.st_size)
+                return {
+                    "inode": stat.st_ino,
+                    "offset": stat.st_size,
+                    "digest": self._digest(filename, stat.st_size),
+                    "generation": blob.generation,
+                }
+            except (
+                gapi_exceptions.NotFound,
+                gapi_exceptions.PreconditionFailed,
+            ):
+                logger.info("%s changed in GCS, re-uploading", full_path)
+
+        with open(filename, "rb") as fileh:
+            blob.upload_from_file(fileh, size=stat.st_size)
+        return {
+            "inode": stat.st_ino,
+            "offset": stat.st_size,
+            "digest": self._digest(filename, stat.st_size),
+            "generation": blob.generation,
+        }
+
+    @staticmethod
+    def _append(gcs_bucket, blob, filename, prev, size):
+        with open(filename, "rb") as fileh:
+            fileh.seek(prev["offset"])
+            data = fileh.read(size - prev["offset"])
+        chunk = gcs_bucket.blob(f"{blob.name}.append")
+        chunk.upload_from_string(data)
+        try:
+            blob.compose(
+                [blob, chunk], if_generation_match=prev["generation"]
+            )
+        finally:
+            chunk.delete()
 
-def _slurm_get_job_info(jobid):
-    """Returns the job state, or None if job isn't in the queue"""
-    # N.B - eventually, pyslurm might work with our version of Slurm,
-    # and this can be changed to something more sane.  For now, call squeue
-    try:
+    def _save_state(self):
+        try:
+            self._state_file.write_text(
+                json.dumps(self._state), encoding="utf-8"
+            )
+        except OSError as err:
+            logger.warning("Failed to save log shipping state", exc_info=err)
+
+
+log_shipper = LogShipper(
+    config.get("log_state_file", "/var/tmp/ghpcfe_c2_log_state.json")
+)
+
+
+def _upload_log_files(log_dict):
+    log_shipper.ship(log_dict)
+
+
+def _sacct_jobs(jobids, *extra_args):
+    """Returns the `sacct --json` records for a batch of Slurm jobs"""
+    proc = subprocess.run(
+        [
+            "sacct",
+            "--json",
+            *extra_args,
+            "-j",
+            ",".join(str(jobid) for jobid in jobids),
+        ],
+        check=True,
+        stdout=subprocess.PIPE,
+    )
+    return json.loads(proc.stdout)["jobs"]
+
+
+def _slurm_number(value):
+    """Unwrap a Slurm JSON number, which may be {"set": .., "number": ..}"""
+    if isinstance(value, dict):
+        return value.get("number", None) if value.get("set", True) else None
+    return value
+
+
+def _slurm_seconds(value):
+    """Convert a Slurm JSON {"seconds": .., "microseconds": ..} to seconds"""
+    if isinstance(value, dict):
+        return value.get("seconds", 0) + value.get("microseconds", 0) / 1e6
+    return value
+
+
+def _slurm_state_name(state):
+    """Normalise a Slurm JSON job state to a single state name
+
+    Newer Slurm releases report states as a list of flags rather than a
+    plain string (e.g. ["RUNNING"] vs "RUNNING").
+    """
+    if isinstance(state, list):
+        return state[0] if state else None
+    return state
+
+
+class SlurmJobTracker:
+    """Shared tracker for the Slurm state of jobs submitted by this daemon
+
+    Rather than each handler polling the queue on its own, a single
+    background thread makes one `squeue --json` call per tick, indexes the
+    result by job id and wakes any handler waiting on a job whose state has
+    changed.  Tracked jobs which have left the queue are resolved with a
+    single batched `sacct` query.
+    """
+
+    def __init__(self, interval):
+        self._interval = interval
+        self._cond = threading.Condition()
+        self._states = {}
+        self._thread = None
+
+    def track(self, jobid, state="PENDING"):
+        """Start tracking a Slurm job"""
+        with self._cond:
+            self._states[jobid] = state
+            if not self._thread:
+                self._thread = threading.Thread(
+                    target=self._run, name="slurm-job-tracker", daemon=True
+                )
+                self._thread.start()
+
+    def untrack(self, jobid):
+        """Stop tracking a Slurm job"""
+        with self._cond:
+            self._states.pop(jobid, None)
+
+    def get_state(self, jobid):
+        """Returns the last known state of a tracked job"""
+        with self._cond:
+            return self._states.get(jobid, None)
+
+    def wait_while(self, jobid, states, timeout=None):
+        """Block while the job is in one of `states`
+
+        Returns the job's state once it changes to something outside of
+        `states`, or its current state if `timeout` seconds pass first.
+        """
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._states.get(jobid, None) not in states,
+                timeout=timeout,
+            )
+            return self._states.get(jobid, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            with self._cond:
+                jobids = list(self._states)
+            if not jobids:
+                continue
+            try:
+                updates = self._query(jobids)
+            except Exception as err:
+                logger.error("Failed to query Slurm job states", exc_info=err)
+                continue
+            with self._cond:
+                changed = False
+                for jobid, state in updates.items():
+                    if jobid not in self._states:
+                        continue
+                    if self._states[jobid] != state:
+                        logger.debug(
+                            "Slurm job %s: %s -> %s",
+                            jobid,
+                            self._states[jobid],
+                            state,
+                        )
+                        self._states[jobid] = state
+                        changed = True
+                if changed:
+                    self._cond.notify_all()
+
+    def _query(self, jobids):
+        # N.B - eventually, pyslurm might work with our version of Slurm,
+        # and this can be changed to something more sane.  For now, call
+        # squeue once for the whole queue, and sacct for anything missing
         proc = subprocess.run(
             ["squeue", "--json"], check=True, stdout=subprocess.PIPE
         )
-        output = json.loads(proc.stdout)
-        for job in output["jobs"]:
-            if job["job_id"] == jobid:
-                return job
-        return None
-    except Exception as err:
-        logger.error("Subprocess threw an error", exc_info=err)
-        return None
+        queue = {
+            job["job_id"]: _slurm_state_name(job.get("job_state", None))
+            for job in json.loads(proc.stdout)["jobs"]
+        }
+        states = {jobid: queue[jobid] for jobid in jobids if jobid in queue}
+
+        missing = [jobid for jobid in jobids if jobid not in states]
+        if missing:
+            try:
+                accounted = _sacct_jobs(missing, "-X")
+            except Exception as err:
+                # Leave these jobs in their last known state, and retry them
+                # next time
+                logger.error("sacct threw an error", exc_info=err)
+                return states
+            for job in accounted:
+                states[job["job_id"]] = _slurm_state_name(
+                    job["state"]["current"]
+                )
+            # Jobs neither in the queue nor accounting are gone
+            for jobid in missing:
+                states.setdefault(jobid, None)
+        return states
 
 
-def _slurm_get_job_state(jobid):
-    """Returns the job state, or None if job isn't in the queue"""
-    # N.B - eventually, pyslurm might work with our version of Slurm,
-    # and this can be changed to something more sane.  For now, call squeue
-    state = _slurm_get_job_info(jobid)
-    return state.get("job_state", None) if state else None
+class SlurmJobAccounting:
+    """Batched completion accounting for finished Slurm jobs
+
+    Once a job has left the queue, squeue no longer knows about it, so its
+    runtime and resource usage must come from Slurm accounting.  Handlers
+    request the accounting for a finished job, and a single background
+    thread makes one `sacct --json` query per interval covering every job
+    still awaiting its accounting record.  Results are cached by job id.
+    """
+
+    CACHE_SIZE = 1024
+
+    def __init__(self, interval, max_wait):
+        self._interval = interval
+        self._max_wait = max_wait
+        self._cond = threading.Condition()
+        self._pending = set()
+        self._results = collections.OrderedDict()
+        self._thread = None
+
+    def get(self, jobid):
+        """Returns the accounting data for a finished job
+
+        Blocks until the job's accounting record is available, or until
+        `max_wait` seconds pass, in which case an empty dict is returned.
+        """
+        with self._cond:
+            if jobid not in self._results:
+                self._pending.add(jobid)
+                if not self._thread:
+                    self._thread = threading.Thread(
+                        target=self._run, name="slurm-accounting", daemon=True
+                    )
+                    self._thread.start()
+                self._cond.wait_for(
+                    lambda: jobid in self._results, timeout=self._max_wait
+                )
+                self._pending.discard(jobid)
+            if jobid not in self._results:
+                logger.warning("No Slurm accounting data for job %s", jobid)
+                return {}
+            return dict(self._results[jobid])
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            with self._cond:
+                jobids = list(self._pending)
+            if not jobids:
+                continue
+            try:
+                records = _sacct_jobs(jobids)
+            except Exception as err:
+                logger.error("Failed to query Slurm accounting", exc_info=err)
+                continue
+            with self._cond:
+                for job in records:
+                    info = self._parse(job)
+                    if info is None:
+                        # slurmdbd hasn't yet recorded the end of the job
+                        continue
+                    self._results[job["job_id"]] = info
+                    self._pending.discard(job["job_id"])
+                while len(self._results) > self.CACHE_SIZE:
+                    self._results.popitem(last=False)
+                self._cond.notify_all()
+
+    @staticmethod
+    def _parse(job):
+        times = job.get("time", {})
+        start = _slurm_number(times.get("start", None))
+        end = _slurm_number(times.get("end", None))
+        if not end:
+            return None
+
+        info = {}
+        elapsed = _slurm_number(times.get("elapsed", None))
+        if elapsed is None and start:
+            elapsed = end - start
+        if elapsed is not None:
+            info["job_runtime"] = elapsed
+
+        cpu_time = _slurm_seconds(times.get("total", None))
+        if cpu_time is not None:
+            info["cpu_time"] = cpu_time
+
+        exit_code = job.get("exit_code", {}).get("return_code", None)
+        exit_code = _slurm_number(exit_code)
+        if exit_code is not None:
+            info["exit_code"] = exit_code
+
+        # Peak memory is reported per step, as the max of the "mem" TRES
+        max_rss = None
+        for step in job.get("steps", []):
+            for tres in step.get("tres", {}).get("requested", {}).get(
+                "max", []
+            ):
+                if tres.get("type", None) == "mem":
+                    count = _slurm_number(tres.get("count", None)) or 0
+                    max_rss = max(max_rss or 0, count)
+        if max_rss is not None:
+            info["max_rss"] = max_rss
+
+        return info
+
+
+job_tracker = SlurmJobTracker(config.get("job_poll_interval", 10))
+job_accounting = SlurmJobAccounting(
+    config.get("accounting_interval", 15),
+    config.get("accounting_max_wait", 300),
+)
 
 
 def _spack_submit_build(app_id, partition, app_name, spec, extra_sbatch=None):
@@ -355,7 +1003,7 @@ def _spack_confirm_install(app_name, log_file):
     return results
 
 
-@cb_in_thread
+@cb_in_thread("SPACK_INSTALL")
 def cb_spack_install(message):
     """Spack application installation handler"""
 
@@ -403,10 +1051,8 @@ def cb_spack_install(message):
         {"ackid": ackid, "app_id": appid, "jobid": jobid, "status": "q"},
     )
 
-    state = "PENDING"
-    while state in ["PENDING", "CONFIGURING"]:
-        time.sleep(30)
-        state = _slurm_get_job_state(jobid)
+    job_tracker.track(jobid)
+    state = job_tracker.wait_while(jobid, ["PENDING", "CONFIGURING"])
     if state == "RUNNING":
         logger.info("Spack build job running for %s:%s", appid, app_name)
         send_message(
@@ -414,8 +1060,8 @@ def cb_spack_install(message):
             {"ackid": ackid, "app_id": appid, "jobid": jobid, "status": "i"},
         )
     while state in ["RUNNING"]:
-        time.sleep(30)
-        state = _slurm_get_job_state(jobid)
+        # Wake periodically to refresh the build logs
+        state = job_tracker.wait_while(jobid, ["RUNNING"], timeout=30)
         try:
             _upload_log_files(
                 {gcs_tgt_out: spack_stdout, gcs_tgt_err: spack_stderr}
@@ -427,6 +1073,7 @@ def cb_spack_install(message):
                 app_name,
                 exc_info=err,
             )
+    job_tracker.untrack(jobid)
     logger.info(
         "Job for %s:%s completed with result %s", appid, app_name, state
     )
@@ -503,7 +1150,7 @@ exec {install_script}
         return (None, err.stdout, err.stderr)
 
 
-@cb_in_thread
+@cb_in_thread("INSTALL_APPLICATION")
 def cb_install_app(message):
     """Custom application installation handler"""
 
@@ -534,17 +1181,14 @@ def cb_install_app(message):
     response["status"] = "q"
     send_message("UPDATE", response)
 
-    state = "PENDING"
-    while state in ["PENDING", "CONFIGURING"]:
-        time.sleep(30)
-        state = _slurm_get_job_state(jobid)
+    job_tracker.track(jobid)
+    state = job_tracker.wait_while(jobid, ["PENDING", "CONFIGURING"])
     if state == "RUNNING":
         logger.info("Install job running for %s:%s", appid, app_name)
         response["status"] = "i"
         send_message("UPDATE", response)
-    while state in ["RUNNING"]:
-        time.sleep(30)
-        state = _slurm_get_job_state(jobid)
+    state = job_tracker.wait_while(jobid, ["RUNNING"])
+    job_tracker.untrack(jobid)
     logger.info(
         "Install job for %s:%s completed with result %s",
         appid,
@@ -831,7 +1475,7 @@ exit $result
         return (None, script, err.stdout, err.stderr)
 
 
-@cb_in_thread
+@cb_in_thread("RUN_JOB")
 def cb_run_job(message, **kwargs):
     """Handler for job submission and monitoring"""
     if not "ackid" in message:
@@ -901,19 +1545,16 @@ def cb_run_job(message, **kwargs):
     response["slurm_job_id"] = slurm_jobid
     send_message("UPDATE", response)
 
-    state = "PENDING"
-    while state in ["PENDING", "CONFIGURING"]:
-        time.sleep(30)
-        state = _slurm_get_job_state(slurm_jobid)
+    job_tracker.track(slurm_jobid)
+    state = job_tracker.wait_while(slurm_jobid, ["PENDING", "CONFIGURING"])
 
     if state == "RUNNING":
         logger.info("Job %s running as slurm job %s", jobid, slurm_jobid)
         response["status"] = "r"
         send_message("UPDATE", response)
 
-    while state in ["RUNNING"]:
-        time.sleep(30)
-        state = _slurm_get_job_state(slurm_jobid)
+    state = job_tracker.wait_while(slurm_jobid, ["RUNNING"])
+    job_tracker.untrack(slurm_jobid)
 
     logger.info(
         "Job %s (slurm %s) completed with result %s", jobid, slurm_jobid, state
@@ -922,15 +1563,8 @@ def cb_run_job(message, **kwargs):
     response["status"] = "u"
     send_message("UPDATE", response)
 
-    try:
-        slurm_job_info = _slurm_get_job_info(slurm_jobid)
-        response["job_runtime"] = (
-            slurm_job_info["end_time"] - slurm_job_info["start_time"]
-        )
-    except KeyError:
-        logger.warning(
-            "Job data from SLURM did not include start time and end time"
-        )
+    # Runtime, exit code & resource usage, for cost accounting
+    response.update(job_accounting.get(slurm_jobid))
 
     kpi = job_dir / "kpi.json"
     if kpi.is_file():
@@ -961,7 +1595,7 @@ def cb_run_job(message, **kwargs):
         shutil.rmtree(job_dir)
 
 
-@cb_in_thread
+@cb_in_thread("REGISTER_USER_GCS")
 def cb_register_user_gcs(message, **kwargs):
     """Handle registration of user GCS credentials"""
     if not "ackid" in message:
@@ -1148,7 +1782,10 @@ def callback_handler(message):
         logger.debug("Received message: %s", repr(message.data))
     cmd = message.attributes.get("command", None)
     if cmd in callback_map:
-        callback_map[cmd](json.loads(message.data))
+        if callback_map[cmd](json.loads(message.data)) is False:
+            # Handler can't take this right now - have pubsub redeliver it
+            message.nack()
+            return
     else:
         if cmd:
             logger.warning(
@@ -1161,6 +1798,9 @@ def callback_handler(message):
 
 if __name__ == "__main__":
 
+    if config.get("metrics_port", None):
+        prometheus_client.start_http_server(int(config["metrics_port"]))
+
     streaming_pull_future = subscriber.subscribe(
         config["subscription_path"], callback=callback_handler
     )
@@ -1197,7 +1837,7 @@ if __name__ == "__main__":
         streaming_pull_future.cancel()  # Trigger the shutdown.
         # streaming_pull_future.result()  # Wait for finish
 
-    thread_pool.shutdown(wait=True)
+    scheduler.shutdown(wait=True)
 
     send_message(
         "CLUSTER_STATUS",
@@ -1205,5 +1845,6 @@ if __name__ == "__main__":
             "message": "Cluster C2 Daemon stopping",
         },
     )
+    publisher.stop()
 
     sys.exit(EXIT_CODE)
@@ -209,6 +209,7 @@ sudo su - gcluster -c /bin/bash <<EOF
   printf "\nSet up static contents..."
   python manage.py collectstatic
   python manage.py seed_workbench_presets
+  python manage.py build_spack_index
   popd
 
   printf "\nUpdating nginx config...\n"
@@ -240,7 +241,19 @@ autostart=true
 autorestart=true
 user=gcluster
 redirect_stderr=true
-stdout_logfile=/opt/gcluster/run/supvisor.log" >/etc/supervisord.d/gcluster.ini
+stdout_logfile=/opt/gcluster/run/supvisor.log
+
+[program:gcluster-provisioner]
+directory=/opt/gcluster/hpc-toolkit/community/front-end/website
+command=/opt/gcluster/django-env/bin/python manage.py run_provisioner
+autostart=true
+autorestart=true
+stopasgroup=true
+killasgroup=true
+stopwaitsecs=600
+user=gcluster
+redirect_stderr=true
+stdout_logfile=/opt/gcluster/run/provisioner.log" >/etc/supervisord.d/gcluster.ini
 
 printf "Creating systemd service..."
 echo "[Unit]
@@ -274,6 +287,14 @@ sudo su - gcluster -c /bin/bash <<EOF
   python manage.py setup_grafana "${DJANGO_EMAIL}"
 EOF
 
+printf "Installing Cron entries to reconcile the job spend ledger and warm cloud catalogs"
+tmpcron=$(mktemp)
+crontab -l -u gcluster >"${tmpcron}" 2>/dev/null
+echo "30 * * * * cd /opt/gcluster/hpc-toolkit/community/front-end/website && /opt/gcluster/django-env/bin/python manage.py reconcile_spend_ledger --verbosity 0" >>"${tmpcron}"
+echo "15 */12 * * * cd /opt/gcluster/hpc-toolkit/community/front-end/website && /opt/gcluster/django-env/bin/python manage.py warm_cloud_catalogs --verbosity 0" >>"${tmpcron}"
+crontab -u gcluster "${tmpcron}"
+rm "${tmpcron}"
+
 # If we have a hostname, configure for TLS
 #
 if [ -n "${SERVER_HOSTNAME}" ]; then
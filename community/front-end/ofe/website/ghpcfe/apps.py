@@ -15,7 +15,7 @@
 """Top level Django app definitions"""
 
 from django.apps import AppConfig
-from .cluster_manager import c2
+from .cluster_manager import c2, heartbeat
 
 class GHPCFEConfig(AppConfig):
     name = "ghpcfe"
@@ -24,5 +24,8 @@ class GHPCFEConfig(AppConfig):
     def ready(self):
         # Has side effect of registering various receiver callbacks
         import ghpcfe.signals # pylint:disable=unused-import,import-outside-toplevel
+        # Has side effect of registering C2 response handlers
+        import ghpcfe.c2_handlers # pylint:disable=unused-import,import-outside-toplevel
 
         c2.startup()
+        heartbeat.startup()
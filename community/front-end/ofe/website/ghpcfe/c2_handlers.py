@@ -0,0 +1,153 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Handlers for responses to C2 commands sent to clusters
+
+Each handler is registered by name, which is passed as `on_response` to
+`c2.send_command()`, and is called with the response message and the
+`response_args` given there.
+"""
+
+import logging
+from decimal import Decimal
+
+from .cluster_manager.c2 import response_handler
+from .models import Application, Cluster, Job, Task
+
+logger = logging.getLogger(__name__)
+
+
+@response_handler("RUN_JOB")
+def job_run_response(message, cluster_id, job_id):
+    if message.get("cluster_id") != cluster_id:
+        logger.error(
+            "Cluster ID mismatch versus callback: expected %s, received %s",
+            cluster_id,
+            message.get("cluster_id"),
+        )
+    if message.get("job_id") != job_id:
+        logger.error(
+            "Job ID mismatch versus callback:  expected %s, received %s",
+            job_id,
+            message.get("job_id"),
+        )
+
+    job = Job.objects.get(pk=job_id)
+    job.status = message["status"]
+    logger.info(
+        "Processing job message, id %d, status %s", job_id, job.status
+    )
+
+    if "slurm_job_id" in message and not job.slurm_jobid:
+        job.slurm_jobid = message["slurm_job_id"]
+
+    if job.status in ["c", "e"]:
+        job.runtime = message.get("job_runtime", None)
+        job.exit_code = message.get("exit_code", None)
+        job.cpu_time = message.get("cpu_time", None)
+        job.max_rss = message.get("max_rss", None)
+        job.result_unit = message.get("result_unit", "")
+        job.result_value = message.get("result_value", None)
+        if job.runtime is not None:
+            job.job_cost = (
+                job.number_of_nodes
+                * Decimal(job.runtime)
+                / Decimal(3600)
+                * job.node_price
+            )
+        else:
+            logger.warning(
+                "No runtime reported for job %d, keeping estimated cost",
+                job_id,
+            )
+    job.save()
+
+
+def _app_install_response(message, cluster_id, app_id):
+    if message.get("cluster_id") != cluster_id:
+        logger.error(
+            "Cluster ID mismatch versus callback: expected %s, received %s",
+            cluster_id,
+            message.get("cluster_id"),
+        )
+    if message.get("app_id") != app_id:
+        logger.error(
+            "Application ID mismatch versus callback: expected %s, "
+            "received %s",
+            app_id,
+            message.get("app_id"),
+        )
+
+    if "log_message" in message:
+        logger.info("Install log message: %s", message["log_message"])
+
+    app = Application.objects.get(pk=app_id)
+    app.status = message["status"]
+    return app
+
+
+@response_handler("INSTALL_APPLICATION")
+def custom_install_response(message, cluster_id, app_id):
+    app = _app_install_response(message, cluster_id, app_id)
+    if message["status"] == "r":
+        # TODO App was installed.  Should have more attributes to set
+        pass
+    app.save()
+
+
+@response_handler("SPACK_INSTALL")
+def spack_install_response(message, cluster_id, app_id):
+    app = _app_install_response(message, cluster_id, app_id)
+    if message["status"] == "r":
+        # App was installed.  Should have more attributes to set
+        app.spack_hash = message.get("spack_hash", "")
+        app.load_command = message.get("load_command", "")
+        app.installed_architecture = message.get("spack_arch", "")
+        app.compiler = message.get("compiler", "")
+        app.mpi = message.get("mpi", "")
+    app.save()
+
+
+@response_handler("SYNC")
+def sync_response(message, cluster_id):
+    logger.info("Received SYNC Complete: %s", message)
+    if message.get("cluster_id") != cluster_id:
+        logger.error(
+            "Cluster ID mismatch versus to callback: expected %s, %s",
+            cluster_id,
+            message.get("cluster_id"),
+        )
+    cluster = Cluster.objects.get(pk=cluster_id)
+    cluster.status = message.get("status", "r")
+    cluster.save()
+
+
+@response_handler("REGISTER_USER_GCS")
+def register_user_gcs_response(message, cluster_name, task_id):
+    logger.info(
+        "GCS Auth Status message received from cluster %s: %s",
+        cluster_name,
+        message["status"],
+    )
+    task = Task.objects.get(pk=task_id)
+    task.data.update(message)
+    task.save()
+    if "exit_status" in message:
+        logger.info(
+            "Final result from cluster %s for user auth to GCS was "
+            "status code %s",
+            cluster_name,
+            message["exit_status"],
+        )
+        task.delete()
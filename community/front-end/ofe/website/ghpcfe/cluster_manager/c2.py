@@ -12,9 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """Cluster Manager Backend for GHPCFE"""
+import atexit
+import collections
 import json
 import logging
+import threading
+import time
 import uuid
+from datetime import datetime, timezone
 
 from google.api_core.exceptions import AlreadyExists
 from google.cloud import pubsub
@@ -52,7 +57,29 @@ logger = logging.getLogger(__name__)
 # When receiver finishes the command, they should then send an ACK with that
 # same 'ackid', and any associated data.
 
+# Responses are dispatched to a handler registered by name (see
+# `response_handler()`), along with the JSON-able arguments given to
+# `send_command()`.  The pending (handler, args) for each ackid is kept in the
+# C2Callback table, and cached here so repeated UPDATEs don't hit the DB.
+# Responses that never arrive are expired after CALLBACK_EXPIRY seconds.
+
+# Fan-out commands
+#
+# `send_command_to_clusters()` sends one command to many clusters, each with
+# its own ackid, publishing them as one batch.  The C2FanOut record correlates
+# them, and each cluster's latest UPDATE/ACK is recorded in its
+# C2FanOutResponse, for `get_fanout_results()` to aggregate.
+
 _c2_callbackMap = {}
+_c2_responseHandlers = {}
+
+CALLBACK_EXPIRY = 30 * 24 * 3600
+CALLBACK_CACHE_SIZE = 1024
+FANOUT_TIMEOUT = 300
+
+_pending_responses = collections.OrderedDict()
+_pending_lock = threading.Lock()
+_last_expiry = 0
 
 
 def c2_ping(message, source_id):
@@ -71,33 +98,121 @@ def c2_ping(message, source_id):
 def c2_pong(message, source_id):
     # Expect source_id in the form of 'cluster_{id}'
     if "id" in message:
+        from . import heartbeat
+
         logger.info(
             "Received PONG id %s from cluster %s.", message["id"], source_id
         )
+        heartbeat.record_pong(source_id, message["id"])
     else:
         logger.info("Received PONG from cluster %s", source_id)
     return True
 
 
+def _cache_pending_response(ackid, entry):
+    with _pending_lock:
+        _pending_responses[ackid] = entry
+        _pending_responses.move_to_end(ackid)
+        while len(_pending_responses) > CALLBACK_CACHE_SIZE:
+            _pending_responses.popitem(last=False)
+
+
+def _get_pending_response(ackid):
+    """Returns the (handler name, args, sent time, fan-out id) for ackid,
+    or None"""
+    with _pending_lock:
+        entry = _pending_responses.get(ackid, None)
+    if entry:
+        return entry
+
+    from ..models import C2Callback
+
+    try:
+        record = C2Callback.objects.get(ackid=uuid.UUID(ackid))
+    except (C2Callback.DoesNotExist, ValueError):
+        return None
+    entry = (
+        record.handler,
+        record.args,
+        record.created.timestamp(),
+        record.fanout_id,
+    )
+    _cache_pending_response(ackid, entry)
+    return entry
+
+
+def _remove_pending_response(ackid):
+    from ..models import C2Callback
+
+    with _pending_lock:
+        _pending_responses.pop(ackid, None)
+    try:
+        C2Callback.objects.filter(ackid=uuid.UUID(ackid)).delete()
+    except ValueError:
+        pass
+
+
+def _record_fanout_response(entry, ackid, message, complete):
+    from ..models import C2FanOutResponse
+
+    if not entry[3]:
+        return
+    now = datetime.now(timezone.utc)
+    updates = {"response": message, "updated": now}
+    if complete:
+        updates["completed"] = now
+    C2FanOutResponse.objects.filter(ackid=uuid.UUID(ackid)).update(**updates)
+
+
+def _call_response_handler(entry, message):
+    (name, args, _, _) = entry
+    if not name:
+        return
+    handler = _c2_responseHandlers.get(name, None)
+    if not handler:
+        logger.error("No response handler registered as '%s'", name)
+        return
+    logger.info("Calling response handler '%s'", name)
+    handler(message, **args)
+
+
+def expire_callbacks(max_age=CALLBACK_EXPIRY):
+    """Forget responses to commands sent more than max_age seconds ago"""
+    from ..models import C2Callback, C2FanOut
+
+    global _last_expiry
+    _last_expiry = time.time()
+    cutoff = _last_expiry - max_age
+    (count, _) = C2Callback.objects.filter(
+        created__lt=datetime.fromtimestamp(cutoff, tz=timezone.utc)
+    ).delete()
+    if count:
+        logger.info("Expired %d unanswered C2 command callbacks", count)
+    C2FanOut.objects.filter(
+        created__lt=datetime.fromtimestamp(cutoff, tz=timezone.utc)
+    ).delete()
+    with _pending_lock:
+        for ackid in [
+            k for (k, v) in _pending_responses.items() if v[2] < cutoff
+        ]:
+            del _pending_responses[ackid]
+
+
 # Difference between UPDATE and ACK:  ACK removes the callback, UPDATE leaves it
 # in place
 def cb_ack(message, source_id):
-    from ..models import C2Callback
-
     ackid = message.get("ackid", None)
     logger.info("Received ACK to message %s from %s", ackid, source_id)
     if not ackid:
         logger.error("No ackid in ACK.  Ignoring")
         return True
-    try:
-        entry = C2Callback.objects.get(ackid=uuid.UUID(ackid))
-        logger.info("Calling Callback registered for this ACK")
-        cb = entry.callback
-        entry.delete()
-        cb(message)
-    except C2Callback.DoesNotExist:
+    entry = _get_pending_response(ackid)
+    if entry:
+        _remove_pending_response(ackid)
+        _record_fanout_response(entry, ackid, message, complete=True)
+        _call_response_handler(entry, message)
+    else:
         logger.warning("No Callback registered for the ACK")
-        pass
 
     return True
 
@@ -105,21 +220,17 @@ def cb_ack(message, source_id):
 # Difference between UPDATE and ACK:  ACK removes the callback, UPDATE leaves it
 # in place
 def cb_update(message, source_id):
-    from ..models import C2Callback
-
     ackid = message.get("ackid", None)
     if not ackid:
         logger.error("No ackid in UPDATE.  Ignoring")
         return True
     logger.info("Received UPDATE to message %s from %s", ackid, source_id)
-    try:
-        entry = C2Callback.objects.get(ackid=uuid.UUID(ackid))
-        logger.info("Calling Callback registered for this UPDATE")
-        cb = entry.callback
-        cb(message)
-    except C2Callback.DoesNotExist:
+    entry = _get_pending_response(ackid)
+    if entry:
+        _record_fanout_response(entry, ackid, message, complete=False)
+        _call_response_handler(entry, message)
+    else:
         logger.warning("No Callback registered for the UPDATE")
-        pass
 
     return True
 
@@ -176,11 +287,52 @@ def _c2_response_callback(message):
     message.ack()
 
 
+class _PublishStats:
+    """Counters of message publishing, for monitoring"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.published = 0
+        self.retried = 0
+        self.failed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, published=0, retried=0, failed=0, latency=None):
+        with self._lock:
+            self.published += published
+            self.retried += retried
+            self.failed += failed
+            if latency is not None:
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "published": self.published,
+                "retried": self.retried,
+                "failed": self.failed,
+                "mean_latency": (
+                    self.total_latency / self.published
+                    if self.published
+                    else None
+                ),
+                "max_latency": self.max_latency,
+            }
+
+
 class _C2State:
     """Internal pubsub state management"""
 
     def __init__(self):
         self._pub_client = None
+        self._publish_conf = {}
+        self.publish_stats = _PublishStats()
+        # Guards stopping the publisher against retries publishing
+        self._stop_lock = threading.RLock()
+        self._stopped = False
+        self._retry_timers = set()
         self._sub_client = None
         self._streaming_pull_future = None
         self._project_id = None
@@ -196,11 +348,31 @@ class _C2State:
     @property
     def pub_client(self):
         if not self._pub_client:
-            self._pub_client = pubsub.PublisherClient()
+            batch = self._publish_conf.get("batch", {})
+            flow_control = self._publish_conf.get("flow_control", {})
+            self._pub_client = pubsub.PublisherClient(
+                batch_settings=pubsub.types.BatchSettings(
+                    max_messages=batch.get("max_messages", 100),
+                    max_bytes=batch.get("max_bytes", 1024 * 1024),
+                    max_latency=batch.get("max_latency", 0.05),
+                ),
+                publisher_options=pubsub.types.PublisherOptions(
+                    flow_control=pubsub.types.PublishFlowControl(
+                        message_limit=flow_control.get("message_limit", 1000),
+                        byte_limit=flow_control.get(
+                            "byte_limit", 10 * 1024 * 1024
+                        ),
+                        limit_exceeded_behavior=(
+                            pubsub.types.LimitExceededBehavior.BLOCK
+                        ),
+                    ),
+                ),
+            )
         return self._pub_client
 
     def startup(self):
         conf = utils.load_config()
+        self._publish_conf = conf["server"].get("c2_publish", {})
         self._project_id = conf["server"]["gcp_project"]
         self._topic = conf["server"]["c2_topic"]
         self._topic_path = self.pub_client.topic_path(
@@ -214,7 +386,25 @@ class _C2State:
         self._streaming_pull_future = self.sub_client.subscribe(
             sub_path, callback=_c2_response_callback
         )
-        # TODO: Currently no clean shutdown method
+
+    def shutdown(self):
+        """Stop receiving, and publish any messages still batched"""
+        with self._stop_lock:
+            self._stopped = True
+            for timer in self._retry_timers:
+                timer.cancel()
+            if self._retry_timers:
+                self.publish_stats.record(failed=len(self._retry_timers))
+                logger.error(
+                    "Dropping %d messages awaiting retry: publisher stopped",
+                    len(self._retry_timers),
+                )
+            self._retry_timers.clear()
+        if self._streaming_pull_future:
+            self._streaming_pull_future.cancel()
+        # Outside the lock, as failures of the final batches are retried
+        if self._pub_client:
+            self._pub_client.stop()
 
     def get_subscription_path(self, sub_id):
         sub_id = f"{self._topic}-{sub_id}"
@@ -283,19 +473,89 @@ class _C2State:
             pass
 
     def send_message(self, command, message, target, extra_attrs=None):
+        """Publish a message, returning its delivery future
 
+        Messages are batched, and publishing blocks while too many are
+        outstanding (see the `c2_publish` server configuration).  Failed
+        deliveries are retried, with backoff, up to `retries` times.
+        """
         extra_attrs = extra_attrs if extra_attrs else {}
         # TODO: If we want loopback, need to make 'target' optional,
         # or change up our filters
-        # TODO: Consider if we want to keep the futures or not
-        self.pub_client.publish(
-            self._topic_path,
+        return self._publish(
             bytes(json.dumps(message), "utf-8"),
+            0,
             target=target,
             command=command,
             **extra_attrs,
         )
 
+    def _publish(self, data, attempt, **attrs):
+        start = time.monotonic()
+        future = self.pub_client.publish(self._topic_path, data, **attrs)
+        future.add_done_callback(
+            lambda f: self._on_published(f, start, data, attempt, attrs)
+        )
+        return future
+
+    def _on_published(self, future, start, data, attempt, attrs):
+        try:
+            future.result()
+        # Whatever went wrong, the best we can do is retry
+        except Exception as err:  # pylint: disable=broad-except
+            if attempt < self._publish_conf.get("retries", 3):
+                self.publish_stats.record(retried=1)
+                logger.warning(
+                    "Failed to publish %s to %s (attempt %d), retrying: %s",
+                    attrs.get("command"),
+                    attrs.get("target"),
+                    attempt + 1,
+                    err,
+                )
+                self._schedule_retry(data, attempt, attrs)
+            else:
+                self.publish_stats.record(failed=1)
+                logger.error(
+                    "Dropping %s to %s after %d failed publishes",
+                    attrs.get("command"),
+                    attrs.get("target"),
+                    attempt + 1,
+                    exc_info=err,
+                )
+            return
+        self.publish_stats.record(
+            published=1, latency=time.monotonic() - start
+        )
+
+    def _schedule_retry(self, data, attempt, attrs):
+        with self._stop_lock:
+            if self._stopped:
+                self._drop_stopped(attrs)
+                return
+            timer = threading.Timer(
+                2**attempt, self._retry, args=(data, attempt + 1, attrs)
+            )
+            timer.daemon = True
+            self._retry_timers.add(timer)
+            timer.start()
+
+    def _retry(self, data, attempt, attrs):
+        with self._stop_lock:
+            # Run by the retry's Timer thread
+            self._retry_timers.discard(threading.current_thread())
+            if self._stopped:
+                self._drop_stopped(attrs)
+                return
+            self._publish(data, attempt, **attrs)
+
+    def _drop_stopped(self, attrs):
+        self.publish_stats.record(failed=1)
+        logger.error(
+            "Dropping %s to %s: publisher stopped",
+            attrs.get("command"),
+            attrs.get("target"),
+        )
+
 
 _C2STATE = None
 
@@ -326,6 +586,17 @@ def delete_cluster_subscription(cluster_id, service_account=None):
     )
 
 
+def get_publish_stats():
+    """Returns counters of messages published, retried and dropped, and
+    publish latency (seconds)"""
+    return _C2STATE.publish_stats.as_dict()
+
+
+def shutdown():
+    if _C2STATE:
+        _C2STATE.shutdown()
+
+
 def get_topic_path():
     return _C2STATE._topic_path #pylint: disable=protected-access
 
@@ -338,6 +609,7 @@ def startup():
 
     _C2STATE = _C2State()
     _C2STATE.startup()
+    atexit.register(shutdown)
     # Difference between UPDATE and ACK:  ACK removes the callback, UPDATE
     # leaves it in place
     register_command("ACK", cb_ack)
@@ -347,17 +619,135 @@ def startup():
     register_command("CLUSTER_STATUS", cb_cluster_status)
 
 
-def send_command(cluster_id, cmd, data, on_response=None):
+def send_command(cluster_id, cmd, data, on_response=None, response_args=None):
+    """Send a command to a cluster
+
+    If `on_response` is given, it names a registered response handler (see
+    `response_handler()`) which is called as `handler(message,
+    **response_args)` for each UPDATE and the final ACK from the cluster.
+    `response_args` must be JSON-serializable.  Returns the ackid.
+    """
     if on_response:
         from ..models import C2Callback
 
-        callback_entry = C2Callback(callback=on_response)
-        callback_entry.save()
+        if on_response not in _c2_responseHandlers:
+            raise ValueError(f"Unknown C2 response handler '{on_response}'")
+        if time.time() - _last_expiry > 3600:
+            expire_callbacks()
+
+        callback_entry = C2Callback.objects.create(
+            handler=on_response, args=response_args or {}
+        )
         data["ackid"] = str(callback_entry.ackid)
+        _cache_pending_response(
+            data["ackid"],
+            (
+                callback_entry.handler,
+                callback_entry.args,
+                callback_entry.created.timestamp(),
+                None,
+            ),
+        )
     _C2STATE.send_message(
         command=cmd, message=data, target=get_cluster_sub_id(cluster_id)
     )
-    return data["ackid"]
+    return data.get("ackid", None)
+
+
+def send_command_to_clusters(
+    cluster_ids,
+    cmd,
+    data,
+    on_response=None,
+    response_args=None,
+    timeout=FANOUT_TIMEOUT,
+):
+    """Send the same command to several clusters at once
+
+    Each cluster is sent a copy of `data` with its own ackid, and the
+    messages are published as one batch.  If `on_response` is given, the
+    handler is called as for `send_command()`, with `cluster_id` added to
+    `response_args`.  Clusters which have not sent their ACK within
+    `timeout` seconds are reported as timed out.  Returns the fan-out id,
+    for `get_fanout_results()`.
+    """
+    from django.db import transaction
+
+    from ..models import C2Callback, C2FanOut, C2FanOutResponse
+
+    if on_response and on_response not in _c2_responseHandlers:
+        raise ValueError(f"Unknown C2 response handler '{on_response}'")
+    if time.time() - _last_expiry > 3600:
+        expire_callbacks()
+
+    cluster_ids = list(dict.fromkeys(cluster_ids))
+    with transaction.atomic():
+        fanout = C2FanOut.objects.create(command=cmd, timeout=timeout)
+        responses = C2FanOutResponse.objects.bulk_create(
+            [
+                C2FanOutResponse(fanout=fanout, cluster_id=cluster_id)
+                for cluster_id in cluster_ids
+            ]
+        )
+        callbacks = []
+        for (cluster_id, response) in zip(cluster_ids, responses):
+            callback_entry = C2Callback(
+                ackid=response.ackid, handler="", args={}, fanout=fanout
+            )
+            if on_response:
+                callback_entry.handler = on_response
+                callback_entry.args = {
+                    **(response_args or {}),
+                    "cluster_id": cluster_id,
+                }
+            callbacks.append(callback_entry)
+        C2Callback.objects.bulk_create(callbacks)
+
+    for (cluster_id, callback_entry) in zip(cluster_ids, callbacks):
+        ackid = str(callback_entry.ackid)
+        _cache_pending_response(
+            ackid,
+            (
+                callback_entry.handler,
+                callback_entry.args,
+                fanout.created.timestamp(),
+                fanout.id,
+            ),
+        )
+        _C2STATE.send_message(
+            command=cmd,
+            message={**data, "ackid": ackid},
+            target=get_cluster_sub_id(cluster_id),
+        )
+    logger.info(
+        "Sent %s to %d clusters as fan-out %s", cmd, len(cluster_ids), fanout.id
+    )
+    return fanout.id
+
+
+def get_fanout_results(fanout_id):
+    """Returns the aggregated responses to a `send_command_to_clusters()`
+
+    Returns a dict with the `command`, whether every cluster has `complete`d
+    or timed out, and the `results` of each cluster by ID (see
+    `C2FanOut.results()`), or None if the fan-out is unknown or expired.
+    """
+    from ..models import C2FanOut
+
+    try:
+        fanout = C2FanOut.objects.get(pk=fanout_id)
+    except C2FanOut.DoesNotExist:
+        return None
+    results = fanout.results()
+    return {
+        "command": fanout.command,
+        "created": fanout.created,
+        "timeout": fanout.timeout,
+        "complete": all(
+            r["status"] in ("complete", "timed out") for r in results.values()
+        ),
+        "results": results,
+    }
 
 
 def send_update(cluster_id, comm_id, data):
@@ -370,3 +760,17 @@ def send_update(cluster_id, comm_id, data):
 
 def register_command(command_id, callback):
     _c2_callbackMap[command_id] = callback
+
+
+def register_response_handler(name, handler):
+    _c2_responseHandlers[name] = handler
+
+
+def response_handler(name):
+    """Decorator to register a function as the named response handler"""
+
+    def decorator(func):
+        register_response_handler(name, func)
+        return func
+
+    return decorator
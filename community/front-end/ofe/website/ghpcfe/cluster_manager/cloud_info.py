@@ -14,19 +14,21 @@
 
 """Cloud interrogation routines"""
 
+import hashlib
 import json
 import logging
-import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
 
 import archspec.cpu
 import google.cloud.exceptions
 import googleapiclient.discovery
 from google.cloud import storage as gcs
-from google.cloud.billing_v1.services import cloud_catalog
 from google.oauth2 import service_account
 
+from . import metadata_cache, pricing
+
 logger = logging.getLogger(__name__)
 
 gcp_machine_table = defaultdict(
@@ -68,6 +70,30 @@ def _get_arch_for_node_type_gcp(instance):
         return None
 
 
+def _get_gcp_cached(
+    kind, fetch, credentials, zone=None, per_account=False, **cache_args
+):
+    """Returns `fetch(credentials[, zone])` via the shared metadata cache
+
+    Set `per_account` for results which depend on the credential's service
+    account, not just its project, to cache them per account.
+    """
+    cred_info = json.loads(credentials)
+    if per_account:
+        account = hashlib.sha256(
+            cred_info["client_email"].encode("utf-8")
+        ).hexdigest()[:16]
+        kind = f"{kind}:{account}"
+    args = (credentials, zone) if zone else (credentials,)
+    return metadata_cache.get_metadata_cache().get_or_fetch(
+        cred_info["project_id"],
+        zone or "",
+        kind,
+        lambda: fetch(*args),
+        **cache_args,
+    )
+
+
 def _get_gcp_client(credentials, service="compute", api_version="v1"):
     cred_info = json.loads(credentials)
     creds = service_account.Credentials.from_service_account_info(cred_info)
@@ -79,141 +105,209 @@ def _get_gcp_client(credentials, service="compute", api_version="v1"):
     )
 
 
-@lru_cache
-def _get_gcp_disk_types(
-    credentials, zone, ttl_hash=None
-):  # pylint: disable=unused-argument
+def _list_gcp_items(resource, key, method="list", **kwargs):
+    """Yields every item of a Compute API list, following pagination"""
+    req = getattr(resource, method)(**kwargs)
+    while req is not None:
+        resp = req.execute()
+        yield from resp.get(key, [])
+        req = getattr(resource, f"{method}_next")(
+            previous_request=req, previous_response=resp
+        )
+
+
+def _list_gcp_aggregated_items(resource, key, **kwargs):
+    """Yields (zone, item) for every item of a Compute API aggregatedList,
+    across all zones, following pagination"""
+    req = resource.aggregatedList(**kwargs)
+    while req is not None:
+        resp = req.execute()
+        for (scope, scoped_list) in resp.get("items", {}).items():
+            # Scopes are in the form of zones/<zone>
+            zone = scope.split("/")[-1]
+            for item in scoped_list.get(key, []):
+                yield (zone, item)
+        req = resource.aggregatedList_next(
+            previous_request=req, previous_response=resp
+        )
+
+
+def _get_gcp_aggregated_catalog(credentials, resource, key, **kwargs):
+    """Returns every item of a Compute API aggregatedList, keyed by zone
+
+    Each call builds its own API client, as clients can't be shared between
+    threads.
+    """
     (project, client) = _get_gcp_client(credentials)
+    catalog = defaultdict(list)
+    for (zone, item) in _list_gcp_aggregated_items(
+        getattr(client, resource)(), key, project=project, **kwargs
+    ):
+        catalog[zone].append(item)
+    return catalog
+
+
+def _make_gcp_disk_type(disk_type):
+    return {
+        "description": disk_type["description"],
+        "name": disk_type["name"],
+        "minSizeGB": int(disk_type["validDiskSize"].split("-")[0][:-2]),
+        "maxSizeGB": int(disk_type["validDiskSize"].split("-")[1][:-2]),
+    }
 
-    req = client.diskTypes().list(project=project, zone=zone)
-    resp = req.execute()
+
+def _get_gcp_disk_types(credentials, zone):
+    (project, client) = _get_gcp_client(credentials)
     return [
-        {
-            "description": x["description"],
-            "name": x["name"],
-            "minSizeGB": int(x["validDiskSize"].split("-")[0][:-2]),
-            "maxSizeGB": int(x["validDiskSize"].split("-")[1][:-2]),
-        }
-        for x in resp.get("items", [])
+        _make_gcp_disk_type(x)
+        for x in _list_gcp_items(
+            client.diskTypes(), "items", project=project, zone=zone
+        )
     ]
 
+
+def _get_gcp_disk_type_catalog(credentials):
+    """Returns the disk types of every zone, keyed by zone"""
+    return {
+        zone: [_make_gcp_disk_type(x) for x in disk_types]
+        for (zone, disk_types) in _get_gcp_aggregated_catalog(
+            credentials, "diskTypes", "diskTypes"
+        ).items()
+    }
+
+
 def get_disk_types(cloud_provider, credentials, unused_region, zone):
     if cloud_provider == "GCP":
-        return _get_gcp_disk_types(
-            credentials, zone, ttl_hash=_get_ttl_hash()
+        return _get_gcp_cached(
+            "disk_types", _get_gcp_disk_types, credentials, zone
         )
     else:
         raise Exception(f'Unsupport Cloud Provider "{cloud_provider}"')
 
 
-@lru_cache
-def _get_gcp_machine_types(
-    credentials, zone, ttl_hash=None
-):  # pylint: disable=unused-argument
-    (project, client) = _get_gcp_client(credentials)
-
-    req = client.machineTypes().list(
-        project=project, zone=zone, filter="isSharedCpu=False"
-    )
+def _make_gcp_machine_types(machine_types, accelerator_types):
+    """Returns the machine types of one zone, keyed by name
 
-    resp = req.execute()
-    if "items" not in resp:
-        return []
+    `machine_types` and `accelerator_types` are the zone's API items.
+    """
+    accels = {acc["name"]: acc for acc in accelerator_types}
+    # N1 machines can attach any accelerator other than the A100
+    n1_accels = {
+        name: {
+            "description": acc["description"],
+            "min_count": 0,
+            "max_count": acc["maximumCardsPerInstance"],
+        }
+        for (name, acc) in accels.items()
+        if "nvidia-tesla-a100" not in name
+    }
 
-    data = {
-        mt["name"]: {
+    data = {}
+    for mt in machine_types:
+        family = mt["name"].split("-")[0]
+        if family == "n1":
+            accelerators = n1_accels
+        else:
+            accelerators = {}
+            for acc in mt.get("accelerators", []):
+                acc_name = acc["guestAcceleratorType"]
+                accelerators[acc_name] = {
+                    "min_count": acc["guestAcceleratorCount"],
+                    "max_count": acc["guestAcceleratorCount"],
+                }
+                if acc_name in accels:
+                    accelerators[acc_name]["description"] = accels[acc_name][
+                        "description"
+                    ]
+        data[mt["name"]] = {
             "name": mt["name"],
-            "family": mt["name"].split("-")[0],
+            "family": family,
             "memory": mt["memoryMb"],
             "vCPU": mt["guestCpus"],
             "arch": _get_arch_for_node_type_gcp(mt["name"]),
-            "accelerators": {
-                acc["guestAcceleratorType"]: {
-                    "min_count": acc["guestAcceleratorCount"],
-                    "max_count": acc["guestAcceleratorCount"],
-                }
-                for acc in mt.get("accelerators", [])
-            },
+            "accelerators": accelerators,
         }
-        for mt in resp["items"]
-    }
+    return data
 
-    # Grab the Accelerators
-    accels = (
-        client.acceleratorTypes()
-        .list(project=project, zone=zone)
-        .execute()
+
+def _get_gcp_machine_types(credentials, zone):
+    (project, client) = _get_gcp_client(credentials)
+    machine_types = _list_gcp_items(
+        client.machineTypes(),
+        "items",
+        project=project,
+        zone=zone,
+        filter="isSharedCpu=False",
     )
-    # Set N1-associated Accelerators
-    n1_accels = {
-        acc["name"]: {
-            "description": acc["description"],
-            "min_count": 0,
-            "max_count": acc["maximumCardsPerInstance"],
-        }
-        for acc in accels.get("items", [])
-        if "nvidia-tesla-a100" not in acc["name"]
-    }
-    for mach in data.keys():
-        if data[mach]["family"] == "n1":
-            data[mach]["accelerators"] = n1_accels
-        # Fix up description for A100 (or others)
-        elif data[mach]["accelerators"]:
-            for acc_name in data[mach]["accelerators"].keys():
-                items = [
-                    x
-                    for x in accels.get("items", [])
-                    if x["name"] == acc_name
-                ]
-                if items:
-                    data[mach]["accelerators"][acc_name]["description"] = (
-                        items[0]["description"]
-                    )
+    accelerator_types = _list_gcp_items(
+        client.acceleratorTypes(), "items", project=project, zone=zone
+    )
+    return _make_gcp_machine_types(machine_types, list(accelerator_types))
 
-    return data
 
+def _get_gcp_machine_type_listing(credentials):
+    return _get_gcp_aggregated_catalog(
+        credentials,
+        "machineTypes",
+        "machineTypes",
+        filter="isSharedCpu=False",
+    )
 
-def _get_ttl_hash(seconds=3600 * 24):
-    """Return the same value within `seconds` time period.
 
-    Default to 1 day of caching
-    """
-    return round(time.time() / seconds)
+def _get_gcp_accelerator_type_listing(credentials):
+    return _get_gcp_aggregated_catalog(
+        credentials, "acceleratorTypes", "acceleratorTypes"
+    )
 
 
 def get_machine_types(cloud_provider, credentials, unused_region, zone):
     if cloud_provider == "GCP":
-        return _get_gcp_machine_types(
-            credentials, zone, ttl_hash=_get_ttl_hash()
+        return _get_gcp_cached(
+            "machine_types", _get_gcp_machine_types, credentials, zone
         )
     else:
         raise Exception(f'Unsupport Cloud Provider "{cloud_provider}"')
 
 
-def _get_arch_ancestry(arch):
-    ancestry = {arch.name}
-    for p in arch.parents:
-        ancestry.update(_get_arch_ancestry(p))
-    return ancestry
+# archspec's target tree is static, so ancestry lookups are memoized by name
+@lru_cache(maxsize=None)
+def _get_arch_ancestry(arch_name):
+    """Returns the set of arch_name and all of its ancestors"""
+    ancestry = {arch_name}
+    for p in archspec.cpu.TARGETS[arch_name].parents:
+        ancestry.update(_get_arch_ancestry(p.name))
+    return frozenset(ancestry)
 
 
-def get_common_arch(archs):
-    archs = [archspec.cpu.TARGETS[a] for a in archs]
-    common_arch_set = set.intersection(*[_get_arch_ancestry(a) for a in archs])
+@lru_cache(maxsize=None)
+def _get_common_arch(arch_names):
+    common_arch_set = frozenset.intersection(
+        *[_get_arch_ancestry(a) for a in arch_names]
+    )
     if not common_arch_set:
         return None
     return max([archspec.cpu.TARGETS[a] for a in common_arch_set]).name
 
 
-def get_arch_ancestry(arch_name):
+def get_common_arch(archs):
+    return _get_common_arch(frozenset(archs))
+
+
+@lru_cache(maxsize=None)
+def _get_arch_lineage(arch_name):
     arch = archspec.cpu.TARGETS[arch_name]
     res = [arch_name]
     if arch.family != arch:
         for x in arch.parents:
-            res.extend(get_arch_ancestry(x.name))
-    return res
+            res.extend(_get_arch_lineage(x.name))
+    return tuple(res)
+
+
+def get_arch_ancestry(arch_name):
+    return list(_get_arch_lineage(arch_name))
 
 
+@lru_cache(maxsize=None)
 def get_arch_family(arch):
     return archspec.cpu.TARGETS[arch].family.name
 
@@ -223,28 +317,75 @@ def sort_architectures(arch_names):
     return [x.name for x in sorted(archs)]
 
 
-@lru_cache
-def _get_gcp_region_zone_info(
-    credentials, ttl_hash=None
-):  # pylint: disable=unused-argument
+def _get_gcp_region_zone_info(credentials):
     (project, client) = _get_gcp_client(credentials)
 
-    req = client.zones().list(project=project)
     results = defaultdict(list)
-    while req is not None:
-        resp = req.execute()
-        for zone in resp["items"]:
-            region = "-".join(zone["name"].split("-")[:-1])
-            results[region].append(zone["name"])
-        req = client.zones().list_next(
-            previous_request=req, previous_response=resp
-        )
+    for zone in _list_gcp_items(client.zones(), "items", project=project):
+        region = "-".join(zone["name"].split("-")[:-1])
+        results[region].append(zone["name"])
     return results
 
 
 def get_region_zone_info(cloud_provider, credentials):
     if cloud_provider == "GCP":
-        return _get_gcp_region_zone_info(credentials, ttl_hash=_get_ttl_hash())
+        return defaultdict(
+            list,
+            _get_gcp_cached(
+                "region_zones", _get_gcp_region_zone_info, credentials
+            ),
+        )
+    else:
+        raise Exception("Unsupport Cloud Provider")
+
+
+# Concurrent listings when warming the catalogs
+WARM_WORKERS = 4
+
+
+def _warm_gcp_catalogs(credentials):
+    project = json.loads(credentials)["project_id"]
+    cache = metadata_cache.get_metadata_cache()
+
+    # One aggregated listing per catalog covers every zone - and these are
+    # independent, so run them side by side
+    with ThreadPoolExecutor(max_workers=WARM_WORKERS) as executor:
+        region_info = executor.submit(_get_gcp_region_zone_info, credentials)
+        machine_types = executor.submit(
+            _get_gcp_machine_type_listing, credentials
+        )
+        accelerator_types = executor.submit(
+            _get_gcp_accelerator_type_listing, credentials
+        )
+        disk_types = executor.submit(_get_gcp_disk_type_catalog, credentials)
+        region_info = region_info.result()
+        machine_types = machine_types.result()
+        accelerator_types = accelerator_types.result()
+        disk_types = disk_types.result()
+
+    zones = [zone for zones in region_info.values() for zone in zones]
+    logger.info("Warming catalogs for %d zones in %s", len(zones), project)
+    cache.put(project, "", "region_zones", region_info)
+    for zone in zones:
+        cache.put(
+            project,
+            zone,
+            "machine_types",
+            _make_gcp_machine_types(
+                machine_types.get(zone, []), accelerator_types.get(zone, [])
+            ),
+        )
+        cache.put(project, zone, "disk_types", disk_types.get(zone, []))
+
+
+def warm_catalogs(cloud_provider, credentials):
+    """Fetch the region, machine and disk type catalogs for every zone
+
+    Results are stored in the shared metadata cache, so that interactive
+    pages needn't wait on the cloud APIs.
+    """
+    if cloud_provider == "GCP":
+        return _warm_gcp_catalogs(credentials)
     else:
         raise Exception("Unsupport Cloud Provider")
 
@@ -252,11 +393,10 @@ def get_region_zone_info(cloud_provider, credentials):
 def _get_gcp_subnets(credentials):
     (project, client) = _get_gcp_client(credentials)
 
-    req = client.subnetworks().listUsable(project=project)
-    results = req.execute()
-    entries = results["items"]
     subnets = []
-    for entry in entries:
+    for entry in _list_gcp_items(
+        client.subnetworks(), "items", method="listUsable", project=project
+    ):
         # subnet in the form of https://www.googleapis.com/compute/v1/projects/<project>/regions/<region>/subnetworks/<name>
         tokens = entry["subnetwork"].split("/")
         region = tokens[8]
@@ -270,15 +410,42 @@ def _get_gcp_subnets(credentials):
     return subnets
 
 
-def get_subnets(cloud_provider, credentials):
+class SubnetInventory:
+    """Usable subnets, as [vpc, region, subnet, cidr], indexed by VPC and
+    by region"""
+
+    def __init__(self, subnets):
+        self.subnets = subnets
+        self.by_vpc = defaultdict(list)
+        self.by_region = defaultdict(list)
+        for entry in subnets:
+            self.by_vpc[entry[0]].append(entry)
+            self.by_region[entry[1]].append(entry)
+
+
+# Subnets are created and deleted far more often than the other catalogs
+SUBNET_TTL = 300
+
+
+def get_subnet_inventory(cloud_provider, credentials):
     if cloud_provider == "GCP":
-        return _get_gcp_subnets(credentials)
+        return SubnetInventory(
+            _get_gcp_cached(
+                "subnets",
+                _get_gcp_subnets,
+                credentials,
+                # listUsable depends on the caller's permissions
+                per_account=True,
+                ttl=SUBNET_TTL,
+                max_stale=SUBNET_TTL,
+            )
+        )
     else:
         raise Exception("Unsupport Cloud Provider")
 
 
-_gcp_services_list = None
-_gcp_compute_sku_list = None
+def get_subnets(cloud_provider, credentials):
+    return get_subnet_inventory(cloud_provider, credentials).subnets
 
 
 def _get_gcp_instance_pricing(
@@ -288,28 +455,7 @@ def _get_gcp_instance_pricing(
     instance_type,
     gpu_info=None
 ):
-    global _gcp_services_list
-    global _gcp_compute_sku_list
-
-    creds = service_account.Credentials.from_service_account_info(
-        json.loads(credentials)
-    )
-    catalog = cloud_catalog.CloudCatalogClient(credentials=creds)
-    # Step one:  Find the Compute Engine service
-    if not _gcp_services_list:
-        _gcp_services_list = [
-            x
-            for x in catalog.list_services()
-            if "Compute Engine" == x.display_name
-        ]
-    services = _gcp_services_list
-    if len(services) != 1:
-        raise Exception("Did not find Compute Engine Service")
-    # Step two: Get all the SKUs associated with the Compute Engine service
-    if not _gcp_compute_sku_list:
-        _gcp_compute_sku_list = list(catalog.list_skus(parent=services[0].name))
-
-    skus = [x for x in _gcp_compute_sku_list if region in x.service_regions]
+    index = pricing.get_pricing_index(credentials)
 
     # To zero'th degree, pricing for an instance is made up of:
     #   # cores * Price/PerCore of instance semi-family
@@ -317,156 +463,59 @@ def _get_gcp_instance_pricing(
     #   <OTHER THINGS - local SSD, GPUs, Tier 1 networking>  THESE ARE TODO
     #   # Disk Storage - Just assume a 20GB disk - that's what we currently get
 
-    # Google's Billing API has SKUs, but the SKUs don't map to anything - you
-    # can't get SKU info from the actual products. We have to look up sku's
-    # with pricing info, and try to map the SKU's description to the actual
-    # Compute infrastructure we're using.  We do have to look at the
-    # "description" field, which feels hazardous and liable to change
-
-    def price_expr_to_unit_price(expr):
-        """Convert a "Price Expression" to a unit (hourly) price"""
-        unit = expr.tiered_rates[0].unit_price
-        return unit.units + (unit.nanos * 1e-9)
-
-    def get_disk_price(disk_size, skus):
-        def disk_sku_filter(elem):
-            if elem.category.resource_family != "Storage":
-                return False
-            if elem.category.resource_group != "PDStandard":
-                return False
-            if region not in elem.service_regions:
-                return False
-            if not elem.description.startswith("Storage PD Capacity"):
-                # Filter out 'Regional Storage PD Capacity...'
-                return False
-            return True
-
-        disk_sku = [x for x in skus if disk_sku_filter(x)]
+    def get_disk_price(disk_size):
+        disk_sku = index.lookup(region, "pd-standard", "disk", usage_type=None)
         if len(disk_sku) != 1:
             raise Exception("Failed to find singular appropriate disk")
-        disk_price_expression = disk_sku[0].pricing_info[0].pricing_expression
-        unit_price = price_expr_to_unit_price(disk_price_expression)
-        disk_cost_per_month = disk_size * unit_price
+        disk_cost_per_month = disk_size * disk_sku[0]
         disk_cost_per_hr = disk_cost_per_month / (24 * 30)
         return disk_cost_per_hr
 
-    def get_cpu_price(num_cores, instance_type, skus):
-        instance_description_mapper = {
-            "e2": "E2 Instance Core",
-            "n2d": "N2D AMD Instance Core",
-            "c2": "Compute optimized Core",
-            "c2d": "C2D AMD Instance Core",
-            "t2d": "T2D AMD Instance Core",
-            "a2": "A2 Instance Core",
-            "m1": "Memory-optimized Instance Core",  # ??
-            "m2": "Memory Optimized Upgrade Premium for Memory-optimized Instance Core",  # pylint: disable=line-too-long
-            "n2": "N2 Instance Core",
-            "n1": "Custom Instance Core",  # ??
-        }
+    def get_instance_class(instance_type, descriptions):
         instance_class = instance_type.split("-")[0]
-        if instance_class not in instance_description_mapper:
+        if instance_class not in descriptions:
             raise NotImplementedError(
                 "Do not yet have a price mapping for instance type "
                 f"{instance_type}"
             )
+        return instance_class
 
-        def cpu_sku_filter(elem):
-            if elem.category.resource_family != "Compute":
-                return False
-            if elem.category.resource_group != "CPU":
-                return False
-            if elem.category.usage_type != "OnDemand":
-                return False
-            if region not in elem.service_regions:
-                return False
-            if "Sole Tenancy" in elem.description:
-                return False
-            if not elem.description.startswith(
-                instance_description_mapper[instance_class]
-            ):
-                return False
-            return True
-
-        cpu_sku = [x for x in skus if cpu_sku_filter(x)]
+    def get_cpu_price(num_cores, instance_type):
+        instance_class = get_instance_class(
+            instance_type, pricing.CPU_DESCRIPTIONS
+        )
+        cpu_sku = index.lookup(region, instance_class, "cpu")
         if len(cpu_sku) != 1:
             raise Exception("Failed to find singular appropriate cpu billing")
-        cpu_price_expression = cpu_sku[0].pricing_info[0].pricing_expression
-        unit_price = price_expr_to_unit_price(cpu_price_expression)
-        cpu_price_per_hr = num_cores * unit_price
+        cpu_price_per_hr = num_cores * cpu_sku[0]
         return cpu_price_per_hr
 
-    def get_mem_price(num_gb, instance_type, skus):
-        instance_description_mapper = {
-            "e2": "E2 Instance Ram",
-            "n2d": "N2D AMD Instance Ram",
-            "c2": "Compute optimized Ram",
-            "c2d": "C2D AMD Instance Ram",
-            "t2d": "T2D AMD Instance Ram",
-            "a2": "A2 Instance Ram",
-            "m1": "Memory-optimized Instance Ram",  # ??
-            "n2": "N2 Instance Ram",
-            "n1": "Custom Instance Ram", # ??
-        }
-        # TODO: Deal with 'Extended Instance Ram'
-        instance_class = instance_type.split("-")[0]
-        if instance_class not in instance_description_mapper:
-            raise NotImplementedError(
-                "Do not yet have a price mapping for instance type "
-                f"{instance_type}"
-            )
-
-        def mem_sku_filter(elem):
-            if elem.category.resource_family != "Compute":
-                return False
-            if elem.category.resource_group != "RAM":
-                return False
-            if elem.category.usage_type != "OnDemand":
-                return False
-            if region not in elem.service_regions:
-                return False
-            if "Sole Tenancy" in elem.description:
-                return False
-            if not elem.description.startswith(
-                instance_description_mapper[instance_class]
-            ):
-                return False
-            return True
-
-        mem_sku = [x for x in skus if mem_sku_filter(x)]
+    def get_mem_price(num_gb, instance_type):
+        instance_class = get_instance_class(
+            instance_type, pricing.RAM_DESCRIPTIONS
+        )
+        mem_sku = index.lookup(region, instance_class, "ram")
         if len(mem_sku) != 1:
             raise Exception("Failed to find singular appropriate RAM billing")
-        mem_price_expression = mem_sku[0].pricing_info[0].pricing_expression
-        unit_price = price_expr_to_unit_price(mem_price_expression)
-        ram_price_per_hr = num_gb * unit_price
+        ram_price_per_hr = num_gb * mem_sku[0]
         return ram_price_per_hr
 
-    def get_accel_price(gpu_description, gpu_count, skus):
-        def gpu_sku_filter(elem):
-            if elem.category.resource_family != "Compute":
-                return False
-            if elem.category.resource_group != "GPU":
-                return False
-            if elem.category.usage_type != "OnDemand":
-                return False
-            return elem.description.lower().startswith(
-                gpu_description.lower())
-
-        gpu_sku = [x for x in skus if gpu_sku_filter(x)]
-
+    def get_accel_price(gpu_description, gpu_count):
+        gpu_sku = index.lookup(region, gpu_description, "gpu")
         if len(gpu_sku) != 1:
             raise Exception("Failed to find singular appropriate GPU billing")
-        gpu_price_expression = gpu_sku[0].pricing_info[0].pricing_expression
-        unit_price = price_expr_to_unit_price(gpu_price_expression)
-        gpu_price_per_hr = gpu_count * unit_price
+        gpu_price_per_hr = gpu_count * gpu_sku[0]
         return gpu_price_per_hr
 
 
-    machine = _get_gcp_machine_types(credentials, zone)[instance_type]
+    machine = _get_gcp_cached(
+        "machine_types", _get_gcp_machine_types, credentials, zone
+    )[instance_type]
     instance_price = (
-        get_cpu_price(machine["vCPU"], instance_type, skus)
-        + get_mem_price(machine["memory"] / 1024, instance_type, skus)
+        get_cpu_price(machine["vCPU"], instance_type)
+        + get_mem_price(machine["memory"] / 1024, instance_type)
         # TODO: Actual disk size (20 is GHPC default)
-        + get_disk_price(20.0, skus)
+        + get_disk_price(20.0)
     )
     if gpu_info:
         (gpu_name, gpu_count) = gpu_info
@@ -474,7 +523,7 @@ def _get_gcp_instance_pricing(
             # Need to map GPU name to GPU description for Pricing API
             try:
                 gpu_desc = machine["accelerators"][gpu_name]["description"]
-                instance_price += get_accel_price(gpu_desc, gpu_count, skus)
+                instance_price += get_accel_price(gpu_desc, gpu_count)
             except KeyError as err:
                 raise Exception(
                     "Failed to map accelerator to instance"
@@ -21,10 +21,12 @@
 # 3 - Supplied via commandline
 """Cluster specification and management routines"""
 
+import hashlib
 import json
 import logging
 import subprocess
 
+import yaml
 from django.template import engines as template_engines
 from google.api_core.exceptions import PermissionDenied as GCPPermissionDenied
 from website.settings import SITE_NAME
@@ -32,12 +34,22 @@ from website.settings import SITE_NAME
 from . import c2
 from . import cloud_info
 from . import utils
+from .progress import CommandProgress
 
 from .. import grafana
 from ..models import Cluster, ApplicationInstallationLocation, ComputeInstance
 
 logger = logging.getLogger(__name__)
 
+# Plan saved by _initialize_terraform(), for _apply_terraform() to apply
+TERRAFORM_PLAN_FILE = "tfplan"
+
+
+def _hash(data):
+    return hashlib.sha256(
+        json.dumps(data, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
 
 class ClusterInfo:
     """Expected process:
@@ -95,7 +107,18 @@ class ClusterInfo:
         self.cluster.save()
 
         try:
-            self._run_ghpc()
+            # When a start is rerun (e.g. by the provisioner, after a
+            # restart), ghpc needn't regenerate the deployment if its
+            # blueprint and the toolkit are the same as when it last ran
+            generated = self._get_deployment_fingerprint()
+            if (
+                self.cluster.deployment_fingerprint.get("generated")
+                != generated
+                or not self.get_terraform_dir().exists()
+            ):
+                self._run_ghpc()
+                self.cluster.deployment_fingerprint["generated"] = generated
+                self.cluster.save()
             self._initialize_terraform()
             self._apply_terraform()
 
@@ -408,6 +431,24 @@ deployment_groups:
             logger.exception(f"Exception happened creating blueprint for cluster {self.cluster.name} - {e}")
 
 
+    def _get_toolkit_version(self):
+        """Returns the version of ghpc, and so of the blueprint modules"""
+        try:
+            return subprocess.run(
+                [self.ghpc_path.as_posix(), "--version"],
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def _get_deployment_fingerprint(self):
+        """Returns a hash of the blueprint and the toolkit version"""
+        with (self.cluster_dir / "cluster.yaml").open("r") as f:
+            blueprint = yaml.safe_load(f)
+        return _hash([self._get_toolkit_version(), blueprint])
+
     def _prepare_bootstrap_gcs(self):
         template_dir = (
             self.config["baseDir"]
@@ -434,22 +475,40 @@ deployment_groups:
                         ),
                     }
                 )
+                # Only upload scripts which have changed
+                bootstrap = self.cluster.deployment_fingerprint.setdefault(
+                    "bootstrap", {}
+                )
+                script_hash = _hash(rendered_file)
+                if bootstrap.get(templ) == script_hash:
+                    continue
                 blobpath = f"clusters/{self.cluster.id}/{template_fn.name}"
                 cloud_info.gcs_upload_file(
                     self.config["server"]["gcs_bucket"], blobpath, rendered_file
                 )
+                bootstrap[templ] = script_hash
+        Cluster.objects.filter(pk=self.cluster.pk).update(
+            deployment_fingerprint=self.cluster.deployment_fingerprint
+        )
 
     def _initialize_terraform(self):
+        """Initialise Terraform, and plan the deployment"""
         terraform_dir = self.get_terraform_dir()
         extra_env = {
             "GOOGLE_APPLICATION_CREDENTIALS": self._get_credentials_file()
         }
+        arguments = [
+            f"-out={TERRAFORM_PLAN_FILE}",
+            f"-parallelism={self._get_terraform_parallelism()}",
+        ]
         try:
             logger.info("Invoking Terraform Init")
             utils.run_terraform(terraform_dir, "init")
-            utils.run_terraform(terraform_dir, "validate", extra_env=extra_env)
+            utils.validate_terraform(terraform_dir, extra_env=extra_env)
             logger.info("Invoking Terraform Plan")
-            utils.run_terraform(terraform_dir, "plan", extra_env=extra_env)
+            utils.run_terraform(
+                terraform_dir, "plan", arguments=arguments, extra_env=extra_env
+            )
         except subprocess.CalledProcessError as cpe:
             logger.error("Terraform exec failed", exc_info=cpe)
             if cpe.stdout:
@@ -458,20 +517,42 @@ deployment_groups:
                 logger.info("  STDERR:\n%s\n", cpe.stderr.decode("utf-8"))
             raise
 
+    def _get_terraform_parallelism(self):
+        """Number of concurrent Terraform operations for this cluster
+
+        Set by `terraform_parallelism` in the server configuration, or else
+        scaled with the number of partitions, login nodes and mounts, from
+        Terraform's default of 10 up to 50.
+        """
+        parallelism = self.config["server"].get("terraform_parallelism")
+        if parallelism:
+            return int(parallelism)
+        size = (
+            self.cluster.partitions.count()
+            + self.cluster.num_login_nodes
+            + self.cluster.mount_points.count()
+        )
+        return max(10, min(50, 5 * size))
+
     def _run_ghpc(self):
         target_dir = self.cluster_dir
         try:
             logger.info("Invoking ghpc create")
+            command = [self.ghpc_path.as_posix(), "create", "cluster.yaml"]
+            if (target_dir / self.cluster.cloud_id).exists():
+                # Regenerate the deployment - its Terraform state is kept
+                command.append("-w")
             log_out_fn = target_dir / "ghpc_create_log.stdout"
             log_err_fn = target_dir / "ghpc_create_log.stderr"
             with log_out_fn.open("wb") as log_out:
                 with log_err_fn.open("wb") as log_err:
-                    subprocess.run(
-                        [self.ghpc_path.as_posix(), "create", "cluster.yaml"],
-                        cwd=target_dir,
-                        stdout=log_out,
-                        stderr=log_err,
-                        check=True,
+                    utils.run_streaming(
+                        command,
+                        target_dir,
+                        None,
+                        log_out,
+                        log_err,
+                        CommandProgress(target_dir, "ghpc create"),
                     )
         except subprocess.CalledProcessError as cpe:
             logger.error("ghpc exec failed", exc_info=cpe)
@@ -595,7 +676,20 @@ deployment_groups:
         }
         try:
             logger.info("Invoking Terraform Apply")
-            utils.run_terraform(terraform_dir, "apply", extra_env=extra_env)
+            # Apply exactly the saved plan, rather than planning again
+            try:
+                utils.run_terraform(
+                    terraform_dir,
+                    "apply",
+                    arguments=[
+                        f"-parallelism={self._get_terraform_parallelism()}",
+                        TERRAFORM_PLAN_FILE,
+                    ],
+                    extra_env=extra_env,
+                )
+            finally:
+                # The plan may hold secrets, and can't be applied twice
+                (terraform_dir / TERRAFORM_PLAN_FILE).unlink(missing_ok=True)
 
             # Look for Management and Login Nodes in TF state file
             tf_state_file = terraform_dir / "terraform.tfstate"
@@ -0,0 +1,246 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""C2 liveness monitoring of clusters, by PING/PONG"""
+
+import logging
+import threading
+import time
+import uuid
+
+import googleapiclient.discovery
+from filelock import FileLock, Timeout
+
+from . import c2, utils
+
+# Note: As for c2, Models can't be imported here at startup
+
+# pylint: disable=import-outside-toplevel
+
+logger = logging.getLogger(__name__)
+
+# Defaults for the `c2_heartbeat` server configuration
+DEFAULT_INTERVAL = 30
+DEFAULT_SLOW_RTT = 5.0
+DEFAULT_MAX_MISSED = 3
+
+# Clusters whose C2 daemon should be running
+LIVE_CLUSTER_STATUS = ("i", "r")
+
+RTT_METRIC = "custom.googleapis.com/ofe/c2/rtt"
+LAST_SEEN_METRIC = "custom.googleapis.com/ofe/c2/seconds_since_seen"
+
+
+def _get_conf():
+    conf = utils.load_config()["server"].get("c2_heartbeat", {})
+    return {
+        "interval": conf.get("interval", DEFAULT_INTERVAL),
+        "slow_rtt": conf.get("slow_rtt", DEFAULT_SLOW_RTT),
+        "max_missed": conf.get("max_missed", DEFAULT_MAX_MISSED),
+    }
+
+
+def ping_clusters():
+    """PING every live cluster, marking those which missed the last PING
+
+    Returns the heartbeats of the live clusters.  Clusters which have not
+    answered `max_missed` PINGs in a row are marked unreachable - unless
+    still bootstrapping, and so not yet heard from.
+    """
+    from django.utils import timezone
+
+    from ..models import Cluster, ClusterHeartbeat
+
+    ClusterHeartbeat.objects.exclude(
+        cluster__status__in=LIVE_CLUSTER_STATUS
+    ).delete()
+    cluster_status = dict(
+        Cluster.objects.filter(status__in=LIVE_CLUSTER_STATUS).values_list(
+            "id", "status"
+        )
+    )
+    cluster_ids = list(cluster_status)
+    heartbeats = {
+        hb.cluster_id: hb
+        for hb in ClusterHeartbeat.objects.filter(cluster_id__in=cluster_ids)
+    }
+    created = ClusterHeartbeat.objects.bulk_create(
+        [
+            ClusterHeartbeat(cluster_id=cluster_id)
+            for cluster_id in cluster_ids
+            if cluster_id not in heartbeats
+        ]
+    )
+    heartbeats.update({hb.cluster_id: hb for hb in created})
+
+    max_missed = _get_conf()["max_missed"]
+    now = timezone.now()
+    for heartbeat in heartbeats.values():
+        # The C2 daemon only starts towards the end of the bootstrap
+        bootstrapping = (
+            cluster_status[heartbeat.cluster_id] == "i"
+            and not heartbeat.last_seen
+        )
+        if heartbeat.ping_id and not bootstrapping:
+            heartbeat.missed += 1
+            if heartbeat.missed >= max_missed:
+                heartbeat.health = "d"
+        heartbeat.ping_id = str(uuid.uuid4())
+        heartbeat.ping_sent = now
+    ClusterHeartbeat.objects.bulk_update(
+        heartbeats.values(), ["ping_id", "ping_sent", "missed", "health"]
+    )
+
+    for heartbeat in heartbeats.values():
+        c2.send_command(heartbeat.cluster_id, "PING", {"id": heartbeat.ping_id})
+    return list(heartbeats.values())
+
+
+def record_pong(source_id, ping_id):
+    """Record the round-trip time of the PING answered by a PONG"""
+    from django.utils import timezone
+
+    from ..models import ClusterHeartbeat
+
+    try:
+        cluster_id = int(source_id.split("_", 1)[1])
+    except (AttributeError, IndexError, ValueError):
+        logger.warning("PONG from unexpected source %s", source_id)
+        return
+    heartbeat = ClusterHeartbeat.objects.filter(
+        cluster_id=cluster_id, ping_id=ping_id
+    ).first()
+    if not heartbeat:
+        # Answer to an earlier PING, which has already been counted as missed
+        logger.debug("Stale PONG %s from cluster %s", ping_id, cluster_id)
+        return
+
+    now = timezone.now()
+    rtt = (now - heartbeat.ping_sent).total_seconds()
+    slow = rtt > _get_conf()["slow_rtt"]
+    # Unless the next PING has been sent meanwhile
+    ClusterHeartbeat.objects.filter(
+        cluster_id=cluster_id, ping_id=ping_id
+    ).update(
+        rtt=rtt,
+        last_seen=now,
+        ping_id="",
+        missed=0,
+        health="s" if slow else "o",
+    )
+    if slow:
+        logger.warning(
+            "C2 daemon of cluster %s is slow: PING round-trip %.1fs",
+            cluster_id,
+            rtt,
+        )
+
+
+def _write_metrics(monitoring, heartbeats):
+    """Write RTT and time since last seen to Cloud Monitoring, for Grafana"""
+    from django.utils import timezone
+
+    project = utils.load_config()["server"]["gcp_project"]
+    now = timezone.now()
+    end_time = now.isoformat()
+    series = []
+    for heartbeat in heartbeats:
+        labels = {"cluster_id": str(heartbeat.cluster_id)}
+        if heartbeat.rtt is not None:
+            series.append((RTT_METRIC, labels, heartbeat.rtt))
+        if heartbeat.last_seen:
+            series.append(
+                (
+                    LAST_SEEN_METRIC,
+                    labels,
+                    (now - heartbeat.last_seen).total_seconds(),
+                )
+            )
+    if not series:
+        return
+
+    # At most 200 time series may be written per request
+    for start in range(0, len(series), 200):
+        monitoring.projects().timeSeries().create(
+            name=f"projects/{project}",
+            body={
+                "timeSeries": [
+                    {
+                        "metric": {"type": metric, "labels": labels},
+                        "resource": {
+                            "type": "global",
+                            "labels": {"project_id": project},
+                        },
+                        "points": [
+                            {
+                                "interval": {"endTime": end_time},
+                                "value": {"doubleValue": value},
+                            }
+                        ],
+                    }
+                    for (metric, labels, value) in series[start : start + 200]
+                ]
+            },
+        ).execute()
+
+
+def get_heartbeats(cluster_ids=None):
+    """Returns the liveness of each live cluster (or those in cluster_ids)"""
+    from ..models import ClusterHeartbeat
+
+    heartbeats = ClusterHeartbeat.objects.filter(
+        cluster__status__in=LIVE_CLUSTER_STATUS
+    )
+    if cluster_ids is not None:
+        heartbeats = heartbeats.filter(cluster_id__in=cluster_ids)
+    return [hb.as_dict() for hb in heartbeats.order_by("cluster_id")]
+
+
+def _run():
+    conf = _get_conf()
+    lock_path = utils.load_config()["baseDir"] / "cache" / "heartbeat.lock"
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    # Only one process PINGs the clusters.  The lock is released if that
+    # process exits, when another takes over.
+    lock = FileLock(str(lock_path))
+    while True:
+        try:
+            lock.acquire(timeout=0)
+            break
+        except Timeout:
+            time.sleep(conf["interval"])
+
+    logger.info("C2 heartbeat started, every %ss", conf["interval"])
+    monitoring = googleapiclient.discovery.build(
+        "monitoring", "v3", cache_discovery=False
+    )
+    while True:
+        time.sleep(conf["interval"])
+        try:
+            heartbeats = ping_clusters()
+        # Keep the heartbeat going, whatever the error
+        except Exception as err:  # pylint: disable=broad-except
+            logger.error("C2 heartbeat failed", exc_info=err)
+            continue
+        try:
+            _write_metrics(monitoring, heartbeats)
+        except Exception as err:  # pylint: disable=broad-except
+            logger.warning("Failed to write C2 heartbeat metrics: %s", err)
+
+
+def startup():
+    if _get_conf()["interval"] <= 0:
+        logger.info("C2 heartbeat disabled")
+        return
+    threading.Thread(target=_run, name="c2-heartbeat", daemon=True).start()
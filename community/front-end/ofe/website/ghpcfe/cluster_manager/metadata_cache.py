@@ -0,0 +1,188 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Shared cache of cloud metadata (machine types, disk types, zones...)"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+from filelock import FileLock
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+# Entries are served from the cache for DEFAULT_TTL seconds, and then for up
+# to DEFAULT_MAX_STALE more while being refreshed in the background
+DEFAULT_TTL = 3600 * 24
+DEFAULT_MAX_STALE = 3600 * 24 * 7
+MAX_ENTRIES = 10000
+
+# How long one process may hold a claim to refresh an entry
+_REFRESH_TIMEOUT = 300
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    project TEXT NOT NULL,
+    zone TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    refreshing_until REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (project, zone, kind)
+);
+CREATE INDEX IF NOT EXISTS entries_age ON entries (fetched_at);
+"""
+
+
+class MetadataCache:
+    """SQLite-backed cache of cloud metadata, shared by all processes
+
+    Entries are keyed by (project, zone, kind) - zone is "" for entries
+    which are not zonal - and hold a JSON-serializable value.  Once an entry
+    is older than its TTL, the stale value continues to be returned while
+    one process refreshes it in the background.  The cache holds at most
+    `max_entries` entries, discarding the oldest.
+    """
+
+    def __init__(self, path, max_entries=MAX_ENTRIES):
+        self._path = path
+        self._max_entries = max_entries
+        self._initialised = False
+
+    def _connect(self):
+        if not self._initialised:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            with closing(sqlite3.connect(self._path, timeout=30)) as conn:
+                conn.executescript(_SCHEMA)
+            self._initialised = True
+        return closing(sqlite3.connect(self._path, timeout=30))
+
+    def get(self, project, zone, kind):
+        """Returns (value, age in seconds) for the entry, or None"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value, fetched_at FROM entries "
+                "WHERE project = ? AND zone = ? AND kind = ?",
+                (project, zone, kind),
+            ).fetchone()
+        if not row:
+            return None
+        return (json.loads(row[0]), time.time() - row[1])
+
+    def put(self, project, zone, kind, value):
+        with self._connect() as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries "
+                "(project, zone, kind, value, fetched_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (project, zone, kind, json.dumps(value), time.time()),
+            )
+            conn.execute(
+                "DELETE FROM entries WHERE rowid IN (SELECT rowid FROM "
+                "entries ORDER BY fetched_at DESC LIMIT -1 OFFSET ?)",
+                (self._max_entries,),
+            )
+
+    def _claim_refresh(self, project, zone, kind):
+        """Returns True if this process should refresh the entry"""
+        now = time.time()
+        with self._connect() as conn, conn:
+            cursor = conn.execute(
+                "UPDATE entries SET refreshing_until = ? "
+                "WHERE project = ? AND zone = ? AND kind = ? "
+                "AND refreshing_until < ?",
+                (now + _REFRESH_TIMEOUT, project, zone, kind, now),
+            )
+            return cursor.rowcount == 1
+
+    def _release_refresh(self, project, zone, kind):
+        with self._connect() as conn, conn:
+            conn.execute(
+                "UPDATE entries SET refreshing_until = 0 "
+                "WHERE project = ? AND zone = ? AND kind = ?",
+                (project, zone, kind),
+            )
+
+    def _refresh(self, project, zone, kind, fetch):
+        try:
+            self.put(project, zone, kind, fetch())
+        # Keep serving the stale entry - the next request will retry
+        except Exception as err:  # pylint: disable=broad-except
+            logger.warning(
+                "Failed to refresh %s for %s/%s",
+                kind,
+                project,
+                zone,
+                exc_info=err,
+            )
+            self._release_refresh(project, zone, kind)
+
+    def get_or_fetch(
+        self,
+        project,
+        zone,
+        kind,
+        fetch,
+        ttl=DEFAULT_TTL,
+        max_stale=DEFAULT_MAX_STALE,
+    ):
+        """Returns the cached value, calling `fetch()` to (re)fill the cache
+
+        Fresh entries are returned directly.  Stale entries are returned
+        while being refreshed on a background thread.  Missing, or
+        excessively stale, entries are fetched in the foreground, by only
+        one process at a time.
+        """
+        entry = self.get(project, zone, kind)
+        if entry:
+            (value, age) = entry
+            if age < ttl:
+                return value
+            if age < ttl + max_stale:
+                if self._claim_refresh(project, zone, kind):
+                    threading.Thread(
+                        target=self._refresh,
+                        args=(project, zone, kind, fetch),
+                        daemon=True,
+                    ).start()
+                return value
+
+        lock_path = self._path.parent / "locks" / f"{project}.{zone}.{kind}"
+        lock_path.parent.mkdir(parents=True, exist_ok=True)
+        with FileLock(f"{lock_path}.lock"):
+            # Another process may have fetched it while we waited
+            entry = self.get(project, zone, kind)
+            if entry and entry[1] < ttl:
+                return entry[0]
+            value = fetch()
+            self.put(project, zone, kind, value)
+            return value
+
+
+_cache = None
+
+
+def get_metadata_cache():
+    """Returns the shared metadata cache"""
+    global _cache
+    if not _cache:
+        _cache = MetadataCache(
+            utils.load_config()["baseDir"] / "cache" / "metadata.sqlite3"
+        )
+    return _cache
@@ -0,0 +1,253 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent index of Compute Engine SKU pricing"""
+
+import json
+import logging
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+from filelock import FileLock
+from google.cloud.billing_v1.services import cloud_catalog
+from google.oauth2 import service_account
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+# Rebuild the index from the Cloud Billing catalog once a day
+INDEX_TTL = 3600 * 24
+
+# Google's Billing API has SKUs, but the SKUs don't map to anything - you
+# can't get SKU info from the actual products. We have to look up sku's
+# with pricing info, and try to map the SKU's description to the actual
+# Compute infrastructure we're using.  We do have to look at the
+# "description" field, which feels hazardous and liable to change
+CPU_DESCRIPTIONS = {
+    "e2": "E2 Instance Core",
+    "n2d": "N2D AMD Instance Core",
+    "c2": "Compute optimized Core",
+    "c2d": "C2D AMD Instance Core",
+    "t2d": "T2D AMD Instance Core",
+    "a2": "A2 Instance Core",
+    "m1": "Memory-optimized Instance Core",  # ??
+    "m2": "Memory Optimized Upgrade Premium for Memory-optimized Instance Core",  # pylint: disable=line-too-long
+    "n2": "N2 Instance Core",
+    "n1": "Custom Instance Core",  # ??
+}
+
+RAM_DESCRIPTIONS = {
+    "e2": "E2 Instance Ram",
+    "n2d": "N2D AMD Instance Ram",
+    "c2": "Compute optimized Ram",
+    "c2d": "C2D AMD Instance Ram",
+    "t2d": "T2D AMD Instance Ram",
+    "a2": "A2 Instance Ram",
+    "m1": "Memory-optimized Instance Ram",  # ??
+    "n2": "N2 Instance Ram",
+    "n1": "Custom Instance Ram",  # ??
+}
+# TODO: Deal with 'Extended Instance Ram'
+
+# Spot pricing SKUs share descriptions with their on-demand counterparts,
+# other than this prefix
+_SPOT_PREFIXES = ("Spot Preemptible ", "Preemptible ")
+
+_SCHEMA = """
+CREATE TABLE skus (
+    region TEXT NOT NULL,
+    family TEXT NOT NULL,
+    resource TEXT NOT NULL,
+    usage_type TEXT NOT NULL,
+    unit_price REAL NOT NULL,
+    description TEXT NOT NULL
+);
+CREATE INDEX skus_key ON skus (region, resource, family, usage_type);
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+def _price_expr_to_unit_price(expr):
+    """Convert a "Price Expression" to a unit (hourly) price"""
+    unit = expr.tiered_rates[0].unit_price
+    return unit.units + (unit.nanos * 1e-9)
+
+
+def _classify_sku(sku):
+    """Yields the (family, resource) index keys for a SKU
+
+    family is the machine family for CPU and RAM, the lower-cased
+    description for GPUs, and the disk type for storage.
+    """
+    category = sku.category
+    description = sku.description
+    for prefix in _SPOT_PREFIXES:
+        if description.startswith(prefix):
+            description = description[len(prefix) :]
+            break
+
+    if category.resource_family == "Storage":
+        if category.resource_group != "PDStandard":
+            return
+        if not description.startswith("Storage PD Capacity"):
+            # Filter out 'Regional Storage PD Capacity...'
+            return
+        yield ("pd-standard", "disk")
+
+    if category.resource_family != "Compute":
+        return
+
+    if category.resource_group == "GPU":
+        yield (description.lower(), "gpu")
+        return
+
+    if "Sole Tenancy" in description:
+        return
+    for (resource, descriptions) in (
+        ("cpu", CPU_DESCRIPTIONS),
+        ("ram", RAM_DESCRIPTIONS),
+    ):
+        if category.resource_group != resource.upper():
+            continue
+        for (family, family_description) in descriptions.items():
+            if description.startswith(family_description):
+                yield (family, resource)
+
+
+class PricingIndex:
+    """SQLite-backed index of Compute Engine SKU unit prices
+
+    The whole SKU catalog is fetched once and indexed by region, machine
+    family, resource and usage type (OnDemand or Preemptible), so that
+    price lookups don't have to scan the catalog.  The index is shared by
+    all worker processes, and rebuilt once it is older than `ttl`.
+    """
+
+    def __init__(self, path, ttl=INDEX_TTL):
+        self._path = path
+        self._ttl = ttl
+
+    def _is_fresh(self):
+        try:
+            with closing(sqlite3.connect(self._path)) as conn:
+                row = conn.execute(
+                    "SELECT value FROM meta WHERE key = 'built_at'"
+                ).fetchone()
+        except sqlite3.Error:
+            return False
+        return bool(row) and (time.time() - float(row[0])) < self._ttl
+
+    def ensure_fresh(self, credentials):
+        """Build or rebuild the index, if it is missing or stale"""
+        if self._is_fresh():
+            return
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        with FileLock(f"{self._path}.lock"):
+            # Another process may have built it while we waited
+            if not self._is_fresh():
+                self._build(credentials)
+
+    def _build(self, credentials):
+        logger.info("Building SKU pricing index at %s", self._path)
+        creds = service_account.Credentials.from_service_account_info(
+            json.loads(credentials)
+        )
+        catalog = cloud_catalog.CloudCatalogClient(credentials=creds)
+        # Step one:  Find the Compute Engine service
+        services = [
+            x
+            for x in catalog.list_services()
+            if "Compute Engine" == x.display_name
+        ]
+        if len(services) != 1:
+            raise Exception("Did not find Compute Engine Service")
+
+        # Step two: Index all the SKUs associated with the Compute Engine
+        # service.  Build into a temporary file, and swap it in atomically
+        tmp_path = self._path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.unlink(missing_ok=True)
+        try:
+            with closing(sqlite3.connect(tmp_path)) as conn, conn:
+                conn.executescript(_SCHEMA)
+                for sku in catalog.list_skus(parent=services[0].name):
+                    keys = list(_classify_sku(sku))
+                    if not keys or not sku.pricing_info:
+                        continue
+                    unit_price = _price_expr_to_unit_price(
+                        sku.pricing_info[0].pricing_expression
+                    )
+                    conn.executemany(
+                        "INSERT INTO skus VALUES (?, ?, ?, ?, ?, ?)",
+                        [
+                            (
+                                region,
+                                family,
+                                resource,
+                                sku.category.usage_type,
+                                unit_price,
+                                sku.description,
+                            )
+                            for region in sku.service_regions
+                            for (family, resource) in keys
+                        ],
+                    )
+                conn.execute(
+                    "INSERT INTO meta VALUES ('built_at', ?)", (time.time(),)
+                )
+            os.replace(tmp_path, self._path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    def lookup(self, region, family, resource, usage_type="OnDemand"):
+        """Returns the unit prices of SKUs matching the key
+
+        If `usage_type` is None, SKUs of any usage type match.  GPU SKUs are
+        matched on a (case-insensitive) description prefix.
+        """
+        if resource == "gpu":
+            family = family.lower()
+            query = (
+                "SELECT unit_price FROM skus WHERE region = ? "
+                "AND resource = ? AND family >= ? AND family < ?"
+            )
+            params = [region, resource, family, family + "\U0010ffff"]
+        else:
+            query = (
+                "SELECT unit_price FROM skus WHERE region = ? "
+                "AND resource = ? AND family = ?"
+            )
+            params = [region, resource, family]
+        if usage_type:
+            query += " AND usage_type = ?"
+            params.append(usage_type)
+
+        with closing(sqlite3.connect(self._path)) as conn:
+            return [row[0] for row in conn.execute(query, params)]
+
+
+_index = None
+
+
+def get_pricing_index(credentials):
+    """Returns the shared pricing index, building it if necessary"""
+    global _index
+    if not _index:
+        _index = PricingIndex(
+            utils.load_config()["baseDir"] / "cache" / "pricing.sqlite3"
+        )
+    _index.ensure_fresh(credentials)
+    return _index
@@ -0,0 +1,170 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Live progress of Terraform and ghpc runs, parsed from their output"""
+
+import collections
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_FILE = "progress.json"
+
+# Lines of output kept for the progress report
+TAIL_LINES = 50
+# Minimum seconds between progress file updates
+PUBLISH_INTERVAL = 1.0
+
+# Terraform UI events reporting the progress of a resource
+_RESOURCE_EVENTS = (
+    "apply_start",
+    "apply_progress",
+    "apply_complete",
+    "apply_errored",
+)
+
+
+def _top_module(resource):
+    """Returns the blueprint module ("module.x") that a resource belongs to"""
+    module = resource.get("module", "")
+    return ".".join(module.split(".")[:2]) if module else "root"
+
+
+class CommandProgress:
+    """Follows the output of a command, publishing its progress to a file
+
+    Each line of output is kept in a ring buffer of the last TAIL_LINES
+    lines.  If `json_events` is set, lines are Terraform's machine-readable
+    (`-json`) UI events, which are parsed into the status and timing of each
+    resource, and the time spent in each blueprint module.  The progress is
+    written, at most every PUBLISH_INTERVAL seconds, to PROGRESS_FILE in
+    `target_dir`, for `read_progress()`.
+    """
+
+    def __init__(self, target_dir, command, json_events=False):
+        self._path = Path(target_dir) / PROGRESS_FILE
+        self._json_events = json_events
+        self._tail = collections.deque(maxlen=TAIL_LINES)
+        self._published = 0
+        now = time.time()
+        self._progress = {
+            "command": command,
+            "started": now,
+            "updated": now,
+            "finished": None,
+            "returncode": None,
+            "resources": {},
+            "modules": {},
+            "summary": None,
+        }
+
+    def feed(self, line):
+        """Record a line of output, returning the text to log for it"""
+        text = line
+        if self._json_events:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                event = None
+            if isinstance(event, dict):
+                text = self._parse_event(event)
+        self._tail.append(text.rstrip("\n"))
+        self.publish()
+        return text
+
+    def _parse_event(self, event):
+        now = time.time()
+        hook = event.get("hook", {})
+        kind = event.get("type")
+        if kind in _RESOURCE_EVENTS:
+            resource = hook.get("resource", {})
+            addr = resource.get("addr", "")
+            state = self._progress["resources"].setdefault(
+                addr,
+                {
+                    "module": _top_module(resource),
+                    "action": hook.get("action"),
+                    "status": "running",
+                    "started": now,
+                    "elapsed": 0,
+                },
+            )
+            state["elapsed"] = hook.get(
+                "elapsed_seconds", now - state["started"]
+            )
+            if kind == "apply_complete":
+                state["status"] = "complete"
+            elif kind == "apply_errored":
+                state["status"] = "errored"
+            if kind in ("apply_complete", "apply_errored"):
+                self._update_module(state)
+        elif kind == "change_summary":
+            self._progress["summary"] = event.get("changes")
+
+        text = event.get("@message", "")
+        diagnostic = event.get("diagnostic")
+        if diagnostic and diagnostic.get("detail"):
+            text = f"{text}\n{diagnostic['detail']}"
+        return text + "\n"
+
+    def _update_module(self, state):
+        """Add a finished resource to the timing of its module"""
+        end = state["started"] + state["elapsed"]
+        module = self._progress["modules"].setdefault(
+            state["module"],
+            {
+                "resources": 0,
+                "resource_seconds": 0,
+                "first_start": state["started"],
+                "last_end": end,
+            },
+        )
+        module["resources"] += 1
+        module["resource_seconds"] += state["elapsed"]
+        module["first_start"] = min(module["first_start"], state["started"])
+        module["last_end"] = max(module["last_end"], end)
+        module["wall_seconds"] = module["last_end"] - module["first_start"]
+
+    def publish(self, force=False):
+        now = time.time()
+        if not force and now - self._published < PUBLISH_INTERVAL:
+            return
+        self._published = now
+        self._progress["updated"] = now
+        self._progress["tail"] = list(self._tail)
+        tmp_path = self._path.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            tmp_path.write_text(json.dumps(self._progress), encoding="utf-8")
+            os.replace(tmp_path, self._path)
+        # Progress is informational only - don't fail the command for it
+        except OSError as err:
+            logger.warning("Failed to write progress %s: %s", self._path, err)
+
+    def finish(self, returncode):
+        self._progress["finished"] = time.time()
+        self._progress["returncode"] = returncode
+        self.publish(force=True)
+
+
+def read_progress(target_dir):
+    """Returns the latest progress published in target_dir, or None"""
+    try:
+        with (Path(target_dir) / PROGRESS_FILE).open("r") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
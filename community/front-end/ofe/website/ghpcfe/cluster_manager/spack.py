@@ -15,37 +15,183 @@
 """Spack package operations"""
 
 from . import utils
-import sys
+import json
+import logging
+import os
+import sqlite3
+import subprocess
+import time
+from contextlib import closing
+from pathlib import Path
 
+from filelock import FileLock
+
+# N.B. Spack itself is never imported into the web server - it is slow to
+# load, and large.  Package information is gathered by a helper script run
+# under `spack python`, only when the index needs (re)building.
 spack_prefix = utils.g_baseDir / "dependencies" / "spack"
-spack_path_lib = spack_prefix / "lib" / "spack"
-spack_external_libs = spack_path_lib / "external"
+spack_bin = spack_prefix / "bin" / "spack"
+_dump_packages_script = Path(__file__).parent / "spack_dump_packages.py"
+
+logger = logging.getLogger(__name__)
+
+# How often to check whether the Spack checkout has changed
+_VERSION_CHECK_INTERVAL = 60
+
+_SCHEMA = """
+CREATE TABLE packages (
+    name TEXT PRIMARY KEY,
+    info TEXT NOT NULL
+);
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+def _get_spack_version():
+    """Returns the commit of the Spack checkout, or else Spack's version"""
+    for cmd in (["git", "rev-parse", "HEAD"], [spack_bin, "--version"]):
+        try:
+            return subprocess.run(
+                cmd,
+                cwd=spack_prefix,
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            pass
+    return None
+
+
+def _dump_packages():
+    """Yields the info of each Spack package, from the helper script"""
+    with subprocess.Popen(
+        [spack_bin, "python", _dump_packages_script],
+        cwd=spack_prefix,
+        stdout=subprocess.PIPE,
+        text=True,
+    ) as proc:
+        for line in proc.stdout:
+            yield json.loads(line)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+class SpackPackageIndex:
+    """SQLite-backed index of the packages in the Spack checkout
+
+    Loading Spack's package classes is slow, so their names, versions,
+    variants and descriptions are indexed once per Spack commit and shared
+    by all worker processes.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._checked_at = 0
+
+    def _built_version(self):
+        try:
+            with closing(sqlite3.connect(self._path)) as conn:
+                row = conn.execute(
+                    "SELECT value FROM meta WHERE key = 'spack_version'"
+                ).fetchone()
+        except sqlite3.Error:
+            return None
+        return row[0] if row else None
+
+    def ensure_fresh(self):
+        """Build or rebuild the index, if missing or for another commit"""
+        now = time.time()
+        if now - self._checked_at < _VERSION_CHECK_INTERVAL:
+            return
+        version = _get_spack_version()
+        if not version:
+            logger.warning("No Spack checkout found at %s", spack_prefix)
+        elif self._built_version() != version:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            with FileLock(f"{self._path}.lock"):
+                # Another process may have built it while we waited
+                if self._built_version() != version:
+                    self._build(version)
+        self._checked_at = now
+
+    def _build(self, version):
+        logger.info("Building Spack package index at %s", self._path)
+        tmp_path = self._path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.unlink(missing_ok=True)
+        try:
+            with closing(sqlite3.connect(tmp_path)) as conn, conn:
+                conn.executescript(_SCHEMA)
+                for info in _dump_packages():
+                    conn.execute(
+                        "INSERT INTO packages VALUES (?, ?)",
+                        (info["name"], json.dumps(info)),
+                    )
+                conn.execute(
+                    "INSERT INTO meta VALUES ('spack_version', ?)", (version,)
+                )
+            os.replace(tmp_path, self._path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    def search(self, query="", substring=False, offset=0, limit=None):
+        """Returns (total matches, [names]) of packages matching `query`
+
+        Matches names starting with `query`, or containing it if
+        `substring` is set.  Names are sorted, and `offset` and `limit`
+        select a page of them.
+        """
+        if substring:
+            where = "instr(name, ?) > 0"
+            params = [query]
+        else:
+            where = "name >= ? AND name < ?"
+            params = [query, query + "\U0010ffff"]
+
+        with closing(sqlite3.connect(self._path)) as conn:
+            (total,) = conn.execute(
+                f"SELECT COUNT(*) FROM packages WHERE {where}", params
+            ).fetchone()
+            names = [
+                row[0]
+                for row in conn.execute(
+                    f"SELECT name FROM packages WHERE {where} "
+                    "ORDER BY name LIMIT ? OFFSET ?",
+                    params + [-1 if limit is None else limit, offset],
+                )
+            ]
+        return (total, names)
+
+    def get(self, names):
+        """Returns the info of those packages in `names` which exist"""
+        with closing(sqlite3.connect(self._path)) as conn:
+            results = []
+            for name in names:
+                row = conn.execute(
+                    "SELECT info FROM packages WHERE name = ?", (name,)
+                ).fetchone()
+                if row:
+                    results.append(json.loads(row[0]))
+            return results
+
+
+_index = None
 
-sys.path.insert(0, spack_path_lib.as_posix())
-sys.path.insert(0, spack_external_libs.as_posix())
 
-#pylint: disable=wrong-import-position
-import spack.main
-import spack.repo
-import spack.version
-#pylint: enable=wrong-import-position
+def get_package_index():
+    """Returns the shared package index, building it if necessary"""
+    global _index
+    if not _index:
+        _index = SpackPackageIndex(
+            utils.load_config()["baseDir"] / "cache" / "spack_packages.sqlite3"
+        )
+    _index.ensure_fresh()
+    return _index
 
 
 def get_package_list():
-    return spack.repo.all_package_names()
+    return get_package_index().search()[1]
 
 
 def get_package_info(names):
-    pkgs = [spack.repo.get(name) for name in names]
-    return (
-        {
-            "name": pkg.name,
-            "latest_version": str(
-                spack.version.VersionList(pkg.versions).preferred()
-            ),
-            "versions": [str(v) for v in reversed(sorted(pkg.versions))],
-            "variants": [k for k, v in pkg.variants.items()],
-            "description": pkg.format_doc(),
-        }
-        for pkg in pkgs
-    )
+    return get_package_index().get(names)
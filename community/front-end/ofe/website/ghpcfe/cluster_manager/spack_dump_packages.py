@@ -0,0 +1,49 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Dump Spack package information as JSON lines
+
+Run under `spack python`, so that Spack is only ever loaded in this helper
+process rather than in the web server.  Writes one JSON object per line to
+stdout for each package.
+"""
+
+import json
+import sys
+
+import spack.repo
+import spack.version
+
+
+def main():
+    for name in spack.repo.all_package_names():
+        try:
+            pkg = spack.repo.get(name)
+            info = {
+                "name": pkg.name,
+                "latest_version": str(
+                    spack.version.VersionList(pkg.versions).preferred()
+                ),
+                "versions": [str(v) for v in reversed(sorted(pkg.versions))],
+                "variants": [k for k, v in pkg.variants.items()],
+                "description": pkg.format_doc(),
+            }
+        # Broken package recipes shouldn't break the index
+        except Exception as err:  # pylint: disable=broad-except
+            print(f"Failed to load package {name}: {err}", file=sys.stderr)
+            continue
+        print(json.dumps(info))
+
+
+main()
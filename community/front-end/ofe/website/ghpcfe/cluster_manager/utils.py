@@ -15,14 +15,19 @@
 """Commonly used utility routines"""
 
 import copy
+import hashlib
 import json
 import logging
 import os
+import re
 import subprocess
 from pathlib import Path
 import shutil
 
 import yaml
+from filelock import FileLock
+
+from .progress import CommandProgress
 
 logger = logging.getLogger(__name__)
 
@@ -191,15 +196,170 @@ def rsync_dir(
         raise
 
 
+# Terraform providers are shared by all deployments, through a plugin cache
+# and a local provider mirror, both under this directory.  The mirror holds
+# every provider version that has been installed, and the CLI configuration
+# installs those providers only from it - so `terraform init` of a new
+# deployment needs no downloads.  Terraform doesn't support concurrent use of
+# the plugin cache, so `init` runs are serialised.
+_TF_LOCK_PROVIDER_RE = re.compile(
+    r'^provider "([^"/]+)/([^"/]+)/([^"/]+)" \{\s*version\s*=\s*"([^"]+)"',
+    re.MULTILINE,
+)
+
+
+def _get_terraform_cache_dir():
+    return load_config()["baseDir"] / "cache" / "terraform"
+
+
+def _mirrored_providers(mirror_dir):
+    """Returns the source addresses of providers in the local mirror"""
+    return sorted(
+        "/".join(path.relative_to(mirror_dir).parts)
+        for path in mirror_dir.glob("*/*/*")
+        if path.is_dir()
+    )
+
+
+def _write_terraform_cli_config(cache_dir):
+    """(Re)write the CLI configuration to install mirrored providers locally
+
+    Returns the path of the configuration, or None if the mirror is empty.
+    """
+    mirror_dir = cache_dir / "mirror"
+    cli_config = cache_dir / "terraformrc"
+    providers = _mirrored_providers(mirror_dir) if mirror_dir.is_dir() else []
+    if not providers:
+        cli_config.unlink(missing_ok=True)
+        return None
+    providers = json.dumps(providers)
+    tmp_config = cli_config.with_suffix(f".{os.getpid()}.tmp")
+    tmp_config.write_text(
+        f"""provider_installation {{
+  filesystem_mirror {{
+    path    = "{mirror_dir}"
+    include = {providers}
+  }}
+  direct {{
+    exclude = {providers}
+  }}
+}}
+""",
+        encoding="utf-8",
+    )
+    os.replace(tmp_config, cli_config)
+    return cli_config
+
+
+def _has_unmirrored_providers(target_dir, mirror_dir):
+    """Returns whether the deployment uses providers not in the mirror"""
+    lock_file = Path(target_dir) / ".terraform.lock.hcl"
+    if not lock_file.exists():
+        return False
+    for (host, namespace, name, version) in _TF_LOCK_PROVIDER_RE.findall(
+        lock_file.read_text(encoding="utf-8")
+    ):
+        provider_dir = mirror_dir / host / namespace / name
+        if not any(
+            provider_dir.glob(f"terraform-provider-{name}_{version}_*.zip")
+        ):
+            return True
+    return False
+
+
+def _run_terraform_init(cmdline, target_dir, env, log_out, log_err):
+    cache_dir = _get_terraform_cache_dir()
+    mirror_dir = cache_dir / "mirror"
+    (cache_dir / "plugin-cache").mkdir(parents=True, exist_ok=True)
+    env = dict(env)
+    env["TF_PLUGIN_CACHE_DIR"] = str(cache_dir / "plugin-cache")
+    env["TF_PLUGIN_CACHE_MAY_BREAK_DEPENDENCY_LOCK_FILE"] = "true"
+
+    with FileLock(f"{cache_dir}.lock"):
+        cli_config = _write_terraform_cli_config(cache_dir)
+        local_only = bool(cli_config)
+        if local_only:
+            try:
+                subprocess.run(
+                    cmdline,
+                    cwd=target_dir,
+                    env=dict(env, TF_CLI_CONFIG_FILE=str(cli_config)),
+                    stdout=log_out,
+                    stderr=log_err,
+                    check=True,
+                )
+            except subprocess.CalledProcessError:
+                # Needs a provider version that isn't mirrored yet
+                logger.info(
+                    "Terraform init of %s from local mirror failed, "
+                    "retrying with downloads",
+                    target_dir,
+                )
+                local_only = False
+                for log in (log_out, log_err):
+                    log.seek(0)
+                    log.truncate()
+        if not local_only:
+            subprocess.run(
+                cmdline,
+                cwd=target_dir,
+                env=env,
+                stdout=log_out,
+                stderr=log_err,
+                check=True,
+            )
+
+        if _has_unmirrored_providers(target_dir, mirror_dir):
+            logger.info("Adding providers of %s to local mirror", target_dir)
+            try:
+                subprocess.run(
+                    ["terraform", "providers", "mirror", str(mirror_dir)],
+                    cwd=target_dir,
+                    env=env,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE,
+                    check=True,
+                )
+            # The deployment is initialised regardless
+            except subprocess.CalledProcessError as cpe:
+                logger.warning(
+                    "Failed to mirror Terraform providers: %s", cpe.stderr
+                )
+
+
+def run_streaming(cmdline, cwd, env, log_out, log_err, progress):
+    """Run a command, following its output line by line
+
+    Each line of stdout is passed to `progress` (see `CommandProgress`), and
+    the text it returns is written to `log_out` as it arrives.  stderr is
+    written to `log_err`.  Raises CalledProcessError if the command fails.
+    """
+    with subprocess.Popen(
+        cmdline, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=log_err
+    ) as proc:
+        for line in proc.stdout:
+            text = progress.feed(line.decode("utf-8", errors="replace"))
+            log_out.write(text.encode("utf-8"))
+            log_out.flush()
+    progress.finish(proc.returncode)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmdline)
+
+
 def run_terraform(target_dir, command, arguments=None, extra_env=None):
 
     arguments = arguments if arguments else []
     extra_env = extra_env if extra_env else {}
 
     cmdline = ["terraform", command, "-no-color"]
-    cmdline.extend(arguments)
     if command in ["apply", "destroy"]:
         cmdline.append("-auto-approve")
+    # Machine-readable output, for progress - the log gets the messages
+    json_events = command in ["plan", "apply", "destroy"]
+    if json_events:
+        cmdline.append("-json")
+    # Options must precede any plan file argument
+    cmdline.extend(arguments)
 
     log_out_fn = Path(target_dir) / f"terraform_{command}_log.stdout"
     log_err_fn = Path(target_dir) / f"terraform_{command}_log.stderr"
@@ -213,17 +373,71 @@ def run_terraform(target_dir, command, arguments=None, extra_env=None):
 
     with log_out_fn.open("wb") as log_out:
         with log_err_fn.open("wb") as log_err:
-            subprocess.run(
-                cmdline,
-                cwd=target_dir,
-                env=new_env,
-                stdout=log_out,
-                stderr=log_err,
-                check=True,
-            )
+            if command == "init":
+                _run_terraform_init(
+                    cmdline, target_dir, new_env, log_out, log_err
+                )
+            elif json_events:
+                run_streaming(
+                    cmdline,
+                    target_dir,
+                    new_env,
+                    log_out,
+                    log_err,
+                    CommandProgress(
+                        target_dir, f"terraform {command}", json_events=True
+                    ),
+                )
+            else:
+                subprocess.run(
+                    cmdline,
+                    cwd=target_dir,
+                    env=new_env,
+                    stdout=log_out,
+                    stderr=log_err,
+                    check=True,
+                )
 
     return (log_out_fn, log_err_fn)
 
+def hash_terraform_config(target_dir):
+    """Returns a hash of the Terraform configuration in target_dir
+
+    Only the configuration - `*.tf` files, including those of modules, and
+    the dependency lock file - is hashed, not variable values or state.
+    """
+    target_dir = Path(target_dir)
+    digest = hashlib.sha256()
+    paths = [
+        path
+        for pattern in ("**/*.tf", "**/*.tf.json", ".terraform.lock.hcl")
+        for path in target_dir.glob(pattern)
+        if ".terraform" not in path.relative_to(target_dir).parts
+    ]
+    for path in sorted(paths):
+        digest.update(path.relative_to(target_dir).as_posix().encode())
+        digest.update(b"\0")
+        digest.update(path.read_bytes())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def validate_terraform(target_dir, extra_env=None):
+    """Run `terraform validate`, unless this configuration has passed before
+
+    Validation doesn't depend on variable values or state, so a passing
+    result is cached by the configuration's hash.
+    """
+    validated_dir = _get_terraform_cache_dir() / "validated"
+    marker = validated_dir / hash_terraform_config(target_dir)
+    if marker.exists():
+        logger.info("Terraform configuration in %s already validated", target_dir)
+        return
+    run_terraform(target_dir, "validate", extra_env=extra_env)
+    validated_dir.mkdir(parents=True, exist_ok=True)
+    marker.touch()
+
+
 def run_packer(target_dir, command, arguments=None, extra_env=None):
     """
     Run the Packer command with the specified arguments in the given target directory.
@@ -285,13 +499,13 @@ def run_packer(target_dir, command, arguments=None, extra_env=None):
 
     try:
         with log_out_fn.open("wb") as log_out, log_err_fn.open("wb") as log_err:
-            subprocess.run(
+            run_streaming(
                 cmdline,
-                cwd=target_dir,
-                env=new_env,
-                stdout=log_out,
-                stderr=log_err,
-                check=True,
+                target_dir,
+                new_env,
+                log_out,
+                log_err,
+                CommandProgress(target_dir, f"packer {command}"),
             )
     except subprocess.CalledProcessError as e:
         # Handle the error from Packer command execution
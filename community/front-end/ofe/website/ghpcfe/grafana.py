@@ -21,6 +21,8 @@ from grafana_api.grafana_face import GrafanaFace
 
 from django.conf import settings
 
+from .cluster_manager import heartbeat, utils
+
 logger = logging.getLogger(__name__)
 
 def add_gcp_datasource(name, creds):
@@ -48,6 +50,8 @@ def add_gcp_datasource(name, creds):
 def create_cluster_dashboard(cluster):
 
     cred_info = json.loads(cluster.cloud_credential.detail)
+    # Heartbeat metrics are written to the Frontend's own project
+    server_project = utils.load_config()["server"]["gcp_project"]
     # pylint: disable=line-too-long
     panels = [
         {
@@ -318,7 +322,96 @@ def create_cluster_dashboard(cluster):
                 },
             ],
         },
-
+        {
+            "datasource": "default",
+            "fill": 1,
+            "fillGradient": 0,
+            "gridPos": {
+                "h": 8,
+                "w": 24,
+                "x": 0,
+                "y": 16,
+            },
+            "lines": True,
+            "linewidth": 1,
+            "renderer": "flot",
+            "seriesOverrides": [],
+            "targets": [
+                {
+                    "metricQuery": {
+                        "aliasBy": "Round-trip time",
+                        "alignmentPeriod": "cloud-monitoring-auto",
+                        "crossSeriesReducer": "REDUCE_NONE",
+                        "editorMode": "visual",
+                        "filters": [
+                            "metric.label.cluster_id",
+                            "=",
+                            f"{cluster.id}"
+                        ],
+                        "groupBys": [],
+                        "metricKind": "GAUGE",
+                        "metricType": heartbeat.RTT_METRIC,
+                        "perSeriesAligner": "ALIGN_MAX",
+                        "projectName": server_project,
+                        "query": "",
+                        "unit": "s",
+                        "valueType": "DOUBLE",
+                    },
+                    "queryType": "metrics",
+                    "refId": "C2 RTT",
+                },
+                {
+                    "metricQuery": {
+                        "aliasBy": "Since last PONG",
+                        "alignmentPeriod": "cloud-monitoring-auto",
+                        "crossSeriesReducer": "REDUCE_NONE",
+                        "editorMode": "visual",
+                        "filters": [
+                            "metric.label.cluster_id",
+                            "=",
+                            f"{cluster.id}"
+                        ],
+                        "groupBys": [],
+                        "metricKind": "GAUGE",
+                        "metricType": heartbeat.LAST_SEEN_METRIC,
+                        "perSeriesAligner": "ALIGN_MAX",
+                        "projectName": server_project,
+                        "query": "",
+                        "unit": "s",
+                        "valueType": "DOUBLE",
+                    },
+                    "queryType": "metrics",
+                    "refId": "C2 Last Seen",
+                },
+            ],
+            "title": "C2 Daemon Heartbeat",
+            "type": "graph",
+            "xaxis": {
+                "buckets": None,
+                "mode": "time",
+                "name": None,
+                "show": True,
+                "values": [],
+            },
+            "yaxes": [
+                {
+                    "format": "s",
+                    "label": None,
+                    "logBase": 1,
+                    "max": None,
+                    "min": 0,
+                    "show": True,
+                },
+                {
+                    "format": "short",
+                    "label": None,
+                    "logBase": 1,
+                    "max": None,
+                    "min": None,
+                    "show": False,
+                },
+            ],
+        },
     ]
     # pylint: enable=line-too-long
     dashboard = {
@@ -0,0 +1,32 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Spack package index build"""
+
+from django.core.management.base import BaseCommand
+from ghpcfe.cluster_manager import spack
+
+
+class Command(BaseCommand):
+    """Build the Spack package index"""
+
+    help = (
+        "Indexes the packages of the Spack checkout, if not already indexed "
+        "for its current commit"
+    )
+
+    def handle(self, *args, **options):
+        self.stdout.write("Building Spack package index...", ending="\n")
+        (count, _) = spack.get_package_index().search(limit=0)
+        self.stdout.write(f"{count} Spack packages indexed", ending="\n")
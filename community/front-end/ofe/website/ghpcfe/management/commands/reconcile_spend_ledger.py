@@ -0,0 +1,37 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Spend ledger reconciliation"""
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from ghpcfe.models import SpendLedger
+
+
+class Command(BaseCommand):
+    """Recompute the spend ledger from the job history"""
+
+    help = (
+        "Recomputes each user's spend ledger from their jobs, correcting "
+        "any drift from updates that bypassed the ledger"
+    )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            SpendLedger.reconcile()
+        if options["verbosity"] > 0:
+            self.stdout.write(
+                f"Reconciled {SpendLedger.objects.count()} ledger entries",
+                ending="\n",
+            )
@@ -0,0 +1,39 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Provisioning task worker"""
+
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+from ghpcfe import provisioner
+
+
+class Command(BaseCommand):
+    """Run queued provisioning tasks"""
+
+    help = (
+        "Runs the queued cluster, VPC, filesystem, image and workbench "
+        "provisioning tasks, outside of the web server"
+    )
+
+    def handle(self, *args, **options):
+        stop_event = threading.Event()
+        # Running tasks have their commands stopped.  Those which fail as
+        # a result, or are still running if the provisioner is killed, are
+        # restarted by the next provisioner
+        signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+        signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+        provisioner.run(stop_event)
@@ -0,0 +1,44 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cloud catalog warm-up"""
+
+from django.core.management.base import BaseCommand
+from ghpcfe.cluster_manager import cloud_info
+from ghpcfe.models import Credential
+
+
+class Command(BaseCommand):
+    """Prefetch cloud catalogs for every credential"""
+
+    help = (
+        "Fetches the region, machine type and disk type catalogs available "
+        "to each credential into the shared metadata cache"
+    )
+
+    def handle(self, *args, **options):
+        for credential in Credential.objects.all():
+            if options["verbosity"] > 0:
+                self.stdout.write(
+                    f"Warming catalogs for credential {credential.name}...",
+                    ending="\n",
+                )
+            try:
+                cloud_info.warm_catalogs("GCP", credential.detail)
+            # Carry on with the other credentials
+            except Exception as err:  # pylint: disable=broad-except
+                self.stderr.write(
+                    f"Failed to warm catalogs for {credential.name}: {err}",
+                    ending="\n",
+                )
@@ -13,23 +13,24 @@
 # limitations under the License.
 """ models.py """
 
-import base64
 import json
 import logging
 import re
 import ipaddress
 import uuid
+from datetime import timedelta
 from decimal import Decimal
 
-import dill
 from allauth.socialaccount.models import SocialAccount
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, RegexValidator, MaxLengthValidator
 from django.db import models
+from django.db.models import Count, F, Q, Sum
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from django.utils import timezone
 from rest_framework.authtoken.models import Token
 
 logger = logging.getLogger(__name__)
@@ -133,19 +134,16 @@ class User(AbstractUser):
     )
 
     def total_spend(self, date_range=None, cluster_id=None):
+        if not date_range:
+            # All-time spend is kept up to date in the ledger
+            return SpendLedger.get_spend(self.id, cluster_id)
+
         filters = {"user": self.id}
-        if date_range:
-            filters["date_time_submission__range"] = date_range
+        filters["date_time_submission__range"] = date_range
         if cluster_id:
             filters["cluster"] = cluster_id
 
-        jobs = Job.objects.filter(**filters)
-
-        total_spend = Decimal(0)
-        for job in jobs:
-            total_spend += job.job_cost
-
-        return total_spend
+        return _job_spend(filters)
 
     def total_jobs(self, date_range=None, cluster_id=None):
         filters = {"user": self.id}
@@ -154,9 +152,7 @@ class User(AbstractUser):
         if cluster_id:
             filters["cluster"] = cluster_id
 
-        jobs = Job.objects.filter(**filters)
-
-        return len(jobs)
+        return Job.objects.filter(**filters).count()
 
     def quota_remaining(self):
         return self.quota_amount - self.total_spend()
@@ -175,6 +171,30 @@ class User(AbstractUser):
 
         return False
 
+    def charge_quota_for_job(self, job):
+        """Charge a new job's cost against the user's quota
+
+        Returns False, without charging, if the user has insufficient quota
+        remaining.  The check and charge are a single atomic update, so
+        concurrent submissions can't overrun the quota.  Call this, then
+        save the job, in one transaction.
+        """
+        if self.quota_type == "u":
+            limit = None
+        elif self.quota_type == "l":
+            # Fudge to nearest cent to avoid "apparently equal" issues in
+            # user display
+            limit = self.quota_amount - Decimal("0.005")
+        else:
+            return False
+
+        if not SpendLedger.charge(
+            self.id, job.cluster_id, job.job_cost, limit=limit
+        ):
+            return False
+        job.mark_charged()
+        return True
+
     def get_avatar_url(self):
         """If using social login, return the Google profile picture if
         available"""
@@ -770,6 +790,12 @@ class Cluster(CloudResource):
         null=True,
         blank=True,
     )
+    deployment_fingerprint = models.JSONField(
+        default=dict,
+        blank=True,
+        help_text="Hashes of the generated deployment and the uploaded "
+        "bootstrap scripts",
+    )
     login_node_image = models.ForeignKey(
         Image,
         related_name="login_node_image",
@@ -797,22 +823,43 @@ class Cluster(CloudResource):
         filters = {"cluster": self.id}
         if date_range:
             filters["date_time_submission__range"] = date_range
-        jobs = Job.objects.filter(**filters)
-
-        total_cost = Decimal(0)
-        for job in jobs:
-            total_cost += job.job_cost
 
-        return total_cost
+        return _job_spend(filters)
 
     def total_jobs(self, date_range=None):
         # Django won't accept None on a kwarg to ignore it...
         filters = {"cluster": self.id}
         if date_range:
             filters["date_time_submission__range"] = date_range
-        jobs = Job.objects.filter(**filters)
 
-        return len(jobs)
+        return Job.objects.filter(**filters).count()
+
+    def spend_by_user(self, date_range=None):
+        """Returns the spend and job count of each user of the cluster
+
+        A single grouped query, yielding dicts of {"user": user id, "spend",
+        "jobs"}, in decreasing order of spend.
+        """
+        return self._spend_by("user", date_range)
+
+    def spend_by_application(self, date_range=None):
+        """Returns the spend and job count of each application on the cluster
+
+        A single grouped query, yielding dicts of {"application":
+        application id, "spend", "jobs"}, in decreasing order of spend.
+        """
+        return self._spend_by("application", date_range)
+
+    def _spend_by(self, field, date_range):
+        filters = {"cluster": self.id}
+        if date_range:
+            filters["date_time_submission__range"] = date_range
+        return (
+            Job.objects.filter(**filters)
+            .values(field)
+            .annotate(spend=Sum("job_cost"), jobs=Count("id"))
+            .order_by("-spend")
+        )
 
     def __str__(self):
         """String for representing the Model object."""
@@ -1044,22 +1091,16 @@ class Application(models.Model):
         filters = {"application": self.id}
         if date_range:
             filters["date_time_submission__range"] = date_range
-        jobs = Job.objects.filter(**filters)
-
-        total_spend = Decimal(0)
-        for job in jobs:
-            total_spend += job.job_cost
 
-        return total_spend
+        return _job_spend(filters)
 
     def total_jobs(self, date_range=None):
         # Django won't accept None on a kwarg to ignore it...
         filters = {"application": self.id}
         if date_range:
             filters["date_time_submission__range"] = date_range
-        jobs = Job.objects.filter(**filters)
 
-        return len(jobs)
+        return Job.objects.filter(**filters).count()
 
 
 class CustomInstallationApplication(Application):
@@ -1266,6 +1307,21 @@ class Job(models.Model):
         blank=True,
         null=True,
     )
+    exit_code = models.IntegerField(
+        help_text="Job exit code",  # as reported by scheduler
+        blank=True,
+        null=True,
+    )
+    cpu_time = models.FloatField(
+        help_text="Total CPU time used by the job (in seconds)",
+        blank=True,
+        null=True,
+    )
+    max_rss = models.PositiveBigIntegerField(
+        help_text="Peak resident memory of the job (in bytes)",
+        blank=True,
+        null=True,
+    )
     node_price = models.DecimalField(
         max_digits=8,
         decimal_places=3,
@@ -1311,12 +1367,185 @@ class Job(models.Model):
         null=True,
     )
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember what has been charged to the spend ledger for this job
+        if all(
+            f in instance.__dict__ for f in ("user_id", "cluster_id", "job_cost")
+        ):
+            instance.mark_charged()
+        return instance
+
+    def mark_charged(self):
+        """Record that the job's current cost is reflected in the ledger"""
+        self._ledger_state = (self.user_id, self.cluster_id, self.job_cost)
+
     def __str__(self):
         """String for representing the Model object."""
         return f"#{self.id} - '{self.name}' on {self.application.cluster}"
 
 
+def _job_spend(filters, exclude_job_id=None):
+    """Sum of job_cost over the jobs matching filters, in the database"""
+    jobs = Job.objects.filter(**filters)
+    if exclude_job_id:
+        jobs = jobs.exclude(pk=exclude_job_id)
+    total = jobs.aggregate(total=Sum("job_cost"))
+    return total["total"] or Decimal(0)
+
+
+class SpendLedger(models.Model):
+    """Running total of job spend per user, and per user on each cluster
+
+    The ledger is updated as jobs are created, re-costed or deleted (see
+    signals.py), so quota checks don't need to scan a user's job history.
+    The entry with no cluster holds the user's total spend.  `reconcile()`
+    recomputes the ledger from the Job table, to correct any drift (e.g.
+    from bulk updates, which bypass signals).
+    """
+
+    user = models.ForeignKey(
+        User,
+        related_name="spend_ledger",
+        on_delete=models.CASCADE,
+    )
+    cluster = models.ForeignKey(
+        Cluster,
+        related_name="+",
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+    )
+    spend = models.DecimalField(
+        max_digits=14,
+        decimal_places=3,
+        default=0,
+        help_text="Total job spend to date",
+    )
+    reconciled = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="When the spend was last computed from the Job table",
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "cluster"], name="unique_user_cluster_spend"
+            ),
+            models.UniqueConstraint(
+                fields=["user"],
+                condition=Q(cluster__isnull=True),
+                name="unique_user_total_spend",
+            ),
+        ]
+
+    @staticmethod
+    def _filters(user_id, cluster_id):
+        filters = {"user": user_id}
+        if cluster_id:
+            filters["cluster"] = cluster_id
+        return filters
+
+    @classmethod
+    def _get_entry(cls, user_id, cluster_id, job_id=None):
+        """Returns the ledger entry, creating it from the Job table if need be
+
+        A new entry's spend excludes the job being charged (`job_id`), which
+        may already have been saved.
+        """
+        (entry, _) = cls.objects.get_or_create(
+            user_id=user_id,
+            cluster_id=cluster_id,
+            defaults={
+                "spend": _job_spend(
+                    cls._filters(user_id, cluster_id), exclude_job_id=job_id
+                ),
+                "reconciled": timezone.now(),
+            },
+        )
+        return entry
+
+    @classmethod
+    def get_spend(cls, user_id, cluster_id=None):
+        entry = cls.objects.filter(user=user_id, cluster=cluster_id).first()
+        if entry:
+            return entry.spend
+        # Not charged yet - the entry is created by the first charge
+        return _job_spend(cls._filters(user_id, cluster_id))
+
+    @classmethod
+    def charge(cls, user_id, cluster_id, amount, limit=None, job_id=None):
+        """Add `amount` to the user's spend (on `cluster_id`)
+
+        If `limit` is given, only do so if the user's total spend would
+        not then exceed it.  Returns whether the amount was charged.
+        `job_id` is the job being charged for, if it has been saved.
+        """
+        entries = cls.objects.filter(
+            pk=cls._get_entry(user_id, None, job_id).pk
+        )
+        if limit is not None:
+            entries = entries.filter(spend__lte=limit - amount)
+        if not entries.update(spend=F("spend") + amount):
+            return False
+        if cluster_id:
+            cls.objects.filter(
+                pk=cls._get_entry(user_id, cluster_id, job_id).pk
+            ).update(spend=F("spend") + amount)
+        return True
+
+    @classmethod
+    def reconcile(cls):
+        """Recompute all ledger entries from the Job table
+
+        Entries are only updated if unchanged since before the totals were
+        computed - one charged meanwhile is left for the next reconcile.
+        """
+        now = timezone.now()
+        entries = list(cls.objects.all())
+        totals = {
+            (x["user"], None): x["spend"]
+            for x in Job.objects.values("user").annotate(spend=Sum("job_cost"))
+        }
+        totals.update(
+            {
+                (x["user"], x["cluster"]): x["spend"]
+                for x in Job.objects.exclude(cluster=None)
+                .values("user", "cluster")
+                .annotate(spend=Sum("job_cost"))
+            }
+        )
+        for entry in entries:
+            spend = totals.pop((entry.user_id, entry.cluster_id), Decimal(0))
+            if not cls.objects.filter(pk=entry.pk, spend=entry.spend).update(
+                spend=spend, reconciled=now
+            ):
+                continue
+            if entry.spend != spend:
+                logger.warning(
+                    "Spend ledger for user %s, cluster %s was %s, expected %s",
+                    entry.user_id,
+                    entry.cluster_id,
+                    entry.spend,
+                    spend,
+                )
+        for ((user_id, cluster_id), spend) in totals.items():
+            cls.objects.get_or_create(
+                user_id=user_id,
+                cluster_id=cluster_id,
+                defaults={"spend": spend, "reconciled": now},
+            )
+
+
 class Task(models.Model):
+    """A long-running backend operation, queued for the provisioner"""
+
+    TASK_STATE = (
+        ("q", "Task is queued"),
+        ("r", "Task is running"),
+    )
     owner = models.ForeignKey(
         User,
         help_text="Who is running the task",
@@ -1330,53 +1559,192 @@ class Task(models.Model):
         null=False,
         default=dict,
     )
+    handler = models.CharField(
+        max_length=256,
+        blank=True,
+        help_text="Dotted path of the view class whose cmd() runs the task",
+    )
+    args = models.JSONField(
+        blank=True,
+        default=list,
+        help_text="Arguments for cmd(), with models stored by reference",
+    )
+    credential = models.ForeignKey(
+        Credential,
+        related_name="+",
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        help_text="Credential used, for per-credential concurrency limits",
+    )
+    priority = models.SmallIntegerField(
+        default=0,
+        help_text="Tasks with higher priority run first",
+    )
+    state = models.CharField(
+        max_length=1,
+        choices=TASK_STATE,
+        default="q",
+    )
+    attempts = models.PositiveSmallIntegerField(
+        default=0,
+        help_text="Times the task has been started",
+    )
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["state", "-priority", "created"]),
+        ]
+
 
+class ClusterHeartbeat(models.Model):
+    """Liveness of a cluster's C2 daemon, as measured by PING/PONG"""
+
+    HEALTH = (
+        ("u", "No PONG received yet"),
+        ("o", "C2 daemon is responding"),
+        ("s", "C2 daemon is responding slowly"),
+        ("d", "C2 daemon is unreachable"),
+    )
+    cluster = models.OneToOneField(
+        Cluster,
+        related_name="heartbeat",
+        on_delete=models.CASCADE,
+        primary_key=True,
+    )
+    ping_id = models.CharField(
+        max_length=36,
+        blank=True,
+        help_text="ID of the outstanding PING, if any",
+    )
+    ping_sent = models.DateTimeField(null=True, blank=True)
+    last_seen = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="When the latest PONG was received",
+    )
+    rtt = models.FloatField(
+        null=True,
+        blank=True,
+        help_text="Round-trip time of the latest PING, in seconds",
+    )
+    missed = models.PositiveIntegerField(
+        default=0,
+        help_text="Consecutive PINGs without a PONG",
+    )
+    health = models.CharField(max_length=1, choices=HEALTH, default="u")
 
-class CallbackField(models.TextField):
-    """Serializable Python callbacks for cluster management operations"""
+    def as_dict(self):
+        return {
+            "cluster_id": self.cluster_id,
+            "health": self.get_health_display(),
+            "healthy": self.health == "o",
+            "rtt": self.rtt,
+            "last_seen": self.last_seen,
+            "missed": self.missed,
+        }
 
-    empty_strings_allowed = False
-    description = "Serializable Python Callback"
 
-    # N.B the following pickling operations should realistically only fail either
-    # during development or as the result of package upgrades.  In any case
-    # there is nothing that can be done at runtime to fix the issue so no sense
-    # in trying to carefully pick through exception types
+class C2FanOut(models.Model):
+    """A command sent to several clusters at once
 
-    def to_python(self, value):
-        if isinstance(value, str):
-            try:
-                return dill.loads(base64.decodebytes(bytes(value, "utf-8")))
-            except Exception as err:  # pylint: disable=broad-except
-                logger.exception("Failed to deserialize callback: %s", err)
-                return None
+    Each cluster's response is tracked by a C2FanOutResponse, sharing the
+    ackid of the command sent to that cluster.
+    """
 
-        return value
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    command = models.CharField(max_length=32)
+    created = models.DateTimeField(auto_now_add=True)
+    timeout = models.PositiveIntegerField(
+        help_text="Seconds to wait for each cluster's response",
+    )
 
-    def from_db_value(self, value, unused_expression, unused_connection):
-        try:
-            return dill.loads(base64.decodebytes(bytes(value, "utf-8")))
-        except Exception as err:  # pylint: disable=broad-except
-            logger.exception("Failed to deserialize callback: %s", err)
-            return None
+    def results(self):
+        """Returns the status and latest response of each cluster
 
-    def get_prep_value(self, value):
-        value = super().get_prep_value(value)
-        if value is None:
-            return None
+        Status is one of "pending", "updated" (an UPDATE has been received),
+        "complete" (the ACK has been received) or "timed out".
+        """
+        timed_out = timezone.now() > self.created + timedelta(
+            seconds=self.timeout
+        )
+        results = {}
+        for response in self.responses.all():
+            if response.completed:
+                status = "complete"
+            elif timed_out:
+                status = "timed out"
+            elif response.updated:
+                status = "updated"
+            else:
+                status = "pending"
+            results[response.cluster_id] = {
+                "status": status,
+                "response": response.response,
+                "responded": response.completed or response.updated,
+            }
+        return results
+
+
+class C2FanOutResponse(models.Model):
+    """One cluster's response to a C2FanOut command"""
 
-        try:
-            return base64.encodebytes(dill.dumps(value)).decode("utf-8")
-        except Exception as err:  # pylint: disable=broad-except
-            logger.exception("Failed to serialize callback: %s", err)
-            return None
+    ackid = models.UUIDField(
+        primary_key=True, default=uuid.uuid4, editable=False
+    )
+    fanout = models.ForeignKey(
+        C2FanOut,
+        related_name="responses",
+        on_delete=models.CASCADE,
+    )
+    cluster = models.ForeignKey(
+        Cluster,
+        related_name="+",
+        on_delete=models.CASCADE,
+    )
+    response = models.JSONField(
+        null=True,
+        blank=True,
+        help_text="Latest UPDATE or ACK message from the cluster",
+    )
+    updated = models.DateTimeField(null=True, blank=True)
+    completed = models.DateTimeField(null=True, blank=True)
 
 
 class C2Callback(models.Model):
+    """A pending response to a command sent to a cluster
+
+    Responses are dispatched to the handler registered under `handler` (see
+    c2_handlers.py), called with `args` as keyword arguments.
+    """
+
     ackid = models.UUIDField(
         primary_key=True, default=uuid.uuid4, editable=False
     )
-    callback = CallbackField()
+    handler = models.CharField(
+        max_length=64,
+        help_text="Name of the registered response handler",
+        default="",
+    )
+    args = models.JSONField(
+        blank=True,
+        default=dict,
+        help_text="Keyword arguments to the response handler",
+    )
+    created = models.DateTimeField(
+        auto_now_add=True,
+        help_text="When the command was sent",
+    )
+    fanout = models.ForeignKey(
+        C2FanOut,
+        related_name="+",
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        help_text="Fan-out command this is part of, if any",
+    )
 
 
 class GCPFilestoreFilesystem(Filesystem):
@@ -0,0 +1,251 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Queue of long-running provisioning tasks, and the worker which runs them
+
+Backend views queue their work as Task records (see `enqueue()`), which the
+`run_provisioner` management command runs outside of the web server.  At
+most `max_concurrent` tasks run at once, and at most `max_per_credential`
+for any one cloud credential, highest priority first.  Tasks that were
+running when the provisioner stopped are restarted, up to `max_attempts`
+times in all.  On shutdown, the commands run by tasks are stopped, so they
+don't run on against a deployment that a restarted task is working on, and
+tasks which fail because of it are restarted too.
+"""
+
+import logging
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from django.apps import apps
+from django.db import close_old_connections
+from django.db.models import Model
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from rest_framework.authtoken.models import Token
+
+from .cluster_manager import utils
+from .models import Task
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONCURRENT = 4
+DEFAULT_MAX_PER_CREDENTIAL = 2
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_POLL_INTERVAL = 2
+DEFAULT_STOP_GRACE = 240
+
+
+def _get_conf():
+    conf = utils.load_config()["server"].get("provisioner", {})
+    return {
+        "max_concurrent": conf.get("max_concurrent", DEFAULT_MAX_CONCURRENT),
+        "max_per_credential": conf.get(
+            "max_per_credential", DEFAULT_MAX_PER_CREDENTIAL
+        ),
+        "max_attempts": conf.get("max_attempts", DEFAULT_MAX_ATTEMPTS),
+        "poll_interval": conf.get("poll_interval", DEFAULT_POLL_INTERVAL),
+        "stop_grace": conf.get("stop_grace", DEFAULT_STOP_GRACE),
+    }
+
+
+def _serialize_arg(arg):
+    if isinstance(arg, Model):
+        return {"model": arg._meta.label, "pk": arg.pk}
+    return {"value": arg}
+
+
+def _deserialize_arg(arg):
+    if "model" in arg:
+        return apps.get_model(arg["model"]).objects.get(pk=arg["pk"])
+    return arg["value"]
+
+
+def _get_credential_id(args):
+    for arg in args:
+        credential_id = getattr(arg, "cloud_credential_id", None)
+        if credential_id:
+            return credential_id
+    return None
+
+
+def enqueue(handler, owner, title, args, data=None, priority=0):
+    """Queue `handler().cmd(task_id, token, *args)` to run as a Task
+
+    `handler` is the view class, and `args` are JSON-serializable values or
+    model instances, which are reloaded when the task runs.
+    """
+    task = Task.objects.create(
+        owner=owner,
+        title=title,
+        data=data or {},
+        handler=f"{handler.__module__}.{handler.__qualname__}",
+        args=[_serialize_arg(arg) for arg in args],
+        credential_id=_get_credential_id(args),
+        priority=priority,
+    )
+    logger.info("Queued task %d-%s", task.id, title)
+    return task
+
+
+def _run_task(task, stop_event):
+    interrupted = False
+    try:
+        handler = import_string(task.handler)
+        args = [_deserialize_arg(arg) for arg in task.args]
+        token = Token.objects.get(user_id=task.owner_id).key
+        logger.info("Running task %d-%s", task.id, task.title)
+        handler().cmd(task.id, token, *args)
+        logger.info("Task %d-%s complete", task.id, task.title)
+    # The task's own error handling has done what it can
+    except Exception as err:  # pylint: disable=broad-except
+        # Most likely because its commands were stopped by the shutdown
+        interrupted = stop_event.is_set()
+        if interrupted:
+            logger.warning(
+                "Task %d-%s interrupted by shutdown, to be rerun",
+                task.id,
+                task.title,
+                exc_info=err,
+            )
+        else:
+            logger.error(
+                "Task %d-%s failed", task.id, task.title, exc_info=err
+            )
+    finally:
+        # An interrupted task is left running, for recover_tasks()
+        if not interrupted:
+            Task.objects.filter(pk=task.pk).delete()
+        close_old_connections()
+
+
+def recover_tasks(max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """Requeue tasks left running by a previous provisioner"""
+    abandoned = Task.objects.filter(state="r")
+    for task in abandoned.filter(attempts__gte=max_attempts):
+        logger.error(
+            "Task %d-%s abandoned after %d attempts",
+            task.id,
+            task.title,
+            task.attempts,
+        )
+        task.delete()
+    count = abandoned.update(state="q")
+    if count:
+        logger.info("Requeued %d interrupted tasks", count)
+
+
+def _claim_tasks(running, max_concurrent, max_per_credential):
+    """Mark the next runnable tasks as running, and return them"""
+    claimed = []
+    per_credential = {}
+    for task in running:
+        per_credential[task.credential_id] = (
+            per_credential.get(task.credential_id, 0) + 1
+        )
+    free = max_concurrent - len(running)
+    for task in Task.objects.filter(state="q").exclude(handler="").order_by(
+        "-priority", "created"
+    ):
+        if len(claimed) >= free:
+            break
+        if (
+            task.credential_id
+            and per_credential.get(task.credential_id, 0) >= max_per_credential
+        ):
+            continue
+        if not Task.objects.filter(pk=task.pk, state="q").update(
+            state="r",
+            started=timezone.now(),
+            attempts=task.attempts + 1,
+        ):
+            continue
+        per_credential[task.credential_id] = (
+            per_credential.get(task.credential_id, 0) + 1
+        )
+        claimed.append(task)
+    return claimed
+
+
+def _child_pids():
+    """Returns the IDs of the live child processes of this process"""
+    children = []
+    for stat_path in Path("/proc").glob("[0-9]*/stat"):
+        try:
+            # "pid (comm) state ppid ..." - and comm may contain spaces
+            stat = stat_path.read_text().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        if stat[0] != "Z" and int(stat[1]) == os.getpid():
+            children.append(int(stat_path.parent.name))
+    return children
+
+
+def _terminate_children(grace):
+    """Stop the commands (Terraform, ghpc, etc) run by tasks
+
+    When the whole process group is signalled, as by supervisord, these are
+    already stopping - and a second signal makes Terraform exit at once,
+    without saving its state.  So they are given `grace` seconds to exit
+    before they are sent SIGTERM.
+    """
+    deadline = time.monotonic() + grace
+    while _child_pids() and time.monotonic() < deadline:
+        time.sleep(1)
+    for pid in _child_pids():
+        logger.warning("Terminating task command, pid %d", pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+def run(stop_event=None):
+    """Run queued tasks until `stop_event` is set"""
+    conf = _get_conf()
+    stop_event = stop_event or threading.Event()
+    recover_tasks(conf["max_attempts"])
+    logger.info(
+        "Provisioner running up to %d tasks, %d per credential",
+        conf["max_concurrent"],
+        conf["max_per_credential"],
+    )
+    running = {}
+    with ThreadPoolExecutor(
+        max_workers=conf["max_concurrent"], thread_name_prefix="provisioner"
+    ) as executor:
+        while not stop_event.is_set():
+            for (future, task) in list(running.items()):
+                if future.done():
+                    del running[future]
+            try:
+                for task in _claim_tasks(
+                    list(running.values()),
+                    conf["max_concurrent"],
+                    conf["max_per_credential"],
+                ):
+                    future = executor.submit(_run_task, task, stop_event)
+                    running[future] = task
+            # Keep running the tasks already started
+            except Exception as err:  # pylint: disable=broad-except
+                logger.error("Failed to claim tasks", exc_info=err)
+            stop_event.wait(conf["poll_interval"])
+
+        logger.info("Provisioner stopping, %d tasks running", len(running))
+        if running:
+            _terminate_children(conf["stop_grace"])
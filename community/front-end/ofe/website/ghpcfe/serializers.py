@@ -123,6 +123,9 @@ class JobSerializer(serializers.ModelSerializer):
             "result_data",
             "status",
             "runtime",
+            "exit_code",
+            "cpu_time",
+            "max_rss",
             "node_price",
             "job_cost",
             "result_unit",
@@ -147,7 +150,7 @@ class TaskSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Task
-        fields = ("owner", "title", "data")
+        fields = ("owner", "title", "data", "state")
 
 
 class VirtualNetworkSerializer(serializers.ModelSerializer):
@@ -14,9 +14,15 @@
 
 """Signal handlers for model state"""
 
+import logging
+import threading
+
 from django.db.models.signals import pre_save, post_delete, post_save
 from django.dispatch import receiver
-from .models import Cluster, VirtualNetwork
+from .models import Cluster, Credential, Job, SpendLedger, VirtualNetwork
+from .cluster_manager import cloud_info
+
+logger = logging.getLogger(__name__)
 
 # Pylint misses the sender decorator behaviour here
 #pylint: disable=unused-argument
@@ -56,3 +62,53 @@ def sync_cluster_fs_ip(sender, **kwargs):
                 cluster.controller_node.internal_ip
             )
         cluster.shared_fs.save()
+
+
+@receiver(post_save, sender=Job)
+def update_job_spend(sender, **kwargs):
+    job = kwargs["instance"]
+    old_state = getattr(job, "_ledger_state", None)
+    if old_state is None and not kwargs["created"]:
+        # Don't know what was previously charged - leave it to reconciliation
+        return
+    new_state = (job.user_id, job.cluster_id, job.job_cost)
+    if old_state == new_state:
+        return
+    if old_state:
+        (user_id, cluster_id, cost) = old_state
+        SpendLedger.charge(user_id, cluster_id, -cost)
+    SpendLedger.charge(
+        job.user_id, job.cluster_id, job.job_cost, job_id=job.pk
+    )
+    job.mark_charged()
+
+
+@receiver(post_delete, sender=Job)
+def remove_job_spend(sender, **kwargs):
+    job = kwargs["instance"]
+    old_state = getattr(job, "_ledger_state", None)
+    if old_state:
+        (user_id, cluster_id, cost) = old_state
+        SpendLedger.charge(user_id, cluster_id, -cost)
+
+
+def _warm_catalogs(credential_id, detail):
+    try:
+        cloud_info.warm_catalogs("GCP", detail)
+    # Catalogs will be fetched on demand instead
+    except Exception as err:  # pylint: disable=broad-except
+        logger.warning(
+            "Failed to warm catalogs for credential %s",
+            credential_id,
+            exc_info=err,
+        )
+
+
+@receiver(post_save, sender=Credential)
+def warm_credential_catalogs(sender, **kwargs):
+    credential = kwargs["instance"]
+    threading.Thread(
+        target=_warm_catalogs,
+        args=(credential.id, credential.detail),
+        daemon=True,
+    ).start()
@@ -0,0 +1,84 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the Frontend views"""
+
+import gzip
+import hashlib
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.test import RequestFactory, SimpleTestCase
+
+from .views.clusters import ClusterCostExportView
+
+
+class _Jobs:
+    """Stands in for the QuerySet of job cost rows"""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def iterator(self, chunk_size):  # pylint: disable=unused-argument
+        return iter(self.rows)
+
+
+class ClusterCostExportViewTest(SimpleTestCase):
+    """Cost exports are streamed, not built in memory"""
+
+    rows = [
+        (
+            i,
+            hashlib.sha256(str(i).encode()).hexdigest(),
+            "app",
+            "compute",
+            2,
+            4,
+            i % 3600,
+            0.25,
+            (i % 3600) / 7200,
+            "2023-01-01 00:00:00",
+        )
+        for i in range(20000)
+    ]
+
+    def _export(self, query):
+        view = ClusterCostExportView()
+        view.setup(RequestFactory().get("/", query), pk=1)
+        cluster = mock.Mock()
+        cluster.name = "test"
+        with mock.patch.object(
+            view, "get_object", return_value=cluster
+        ), mock.patch.object(view, "get_jobs", return_value=_Jobs(self.rows)):
+            response = view.get(view.request)
+
+        # As the ASGI handler sends the response
+        async def collect():
+            return [chunk async for chunk in response]
+
+        self.assertTrue(response.is_async)
+        return [chunk for chunk in async_to_sync(collect)() if chunk]
+
+    def test_csv_streamed_in_chunks(self):
+        chunks = self._export({})
+        self.assertGreater(len(chunks), 1)
+        lines = b"".join(chunks).decode("utf-8").splitlines()
+        self.assertEqual(len(lines), len(self.rows) + 1)
+        self.assertTrue(lines[1].startswith(f"0,{self.rows[0][1]},"))
+
+    def test_gzip_streamed_in_chunks(self):
+        chunks = self._export({"gzip": "1"})
+        self.assertGreater(len(chunks), 1)
+        lines = gzip.decompress(b"".join(chunks)).decode("utf-8").splitlines()
+        self.assertEqual(len(lines), len(self.rows) + 1)
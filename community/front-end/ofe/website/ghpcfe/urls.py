@@ -431,6 +431,21 @@ urlpatterns += [
         BackendSyncCluster.as_view(),
         name="backend-sync-cluster",
     ),
+    path(
+        "backend/cluster-sync-all",
+        BackendSyncAllClusters.as_view(),
+        name="backend-sync-all-clusters",
+    ),
+    path(
+        "backend/c2-fanout/<uuid:pk>",
+        BackendFanOutResults.as_view(),
+        name="backend-c2-fanout",
+    ),
+    path(
+        "backend/c2-publish-stats",
+        BackendC2PublishStats.as_view(),
+        name="backend-c2-publish-stats",
+    ),
     path(
         "backend/spack-install/<int:pk>",
         BackendSpackInstall.as_view(),
@@ -351,15 +351,45 @@ class ApplicationViewSet(viewsets.ModelViewSet):
 
 
 class SpackPackageViewSet(viewsets.ViewSet):
-    """Download a list of Spack packages available"""
+    """Download a list of Spack packages available
+
+    With no parameters, lists all package names.  Otherwise, supports:
+        q:          Search for names starting with this
+        contains:   If set, search for names containing `q` instead
+        page:       Page of results to return (from 1)
+        page_size:  Results per page (default 50, max 500)
+    and returns {"count": total matches, "results": [names]}
+    """
+
+    default_page_size = 50
+    max_page_size = 500
 
     def list(self, request):
-        return Response(spack.get_package_list())
+        params = request.query_params
+        if not any(x in params for x in ("q", "page", "page_size")):
+            return Response(spack.get_package_list())
+
+        try:
+            page = max(int(params.get("page", 1)), 1)
+            page_size = min(
+                max(int(params.get("page_size", self.default_page_size)), 1),
+                self.max_page_size,
+            )
+        except ValueError:
+            return Response("Invalid page or page_size", status=400)
+
+        (count, names) = spack.get_package_index().search(
+            params.get("q", ""),
+            substring=bool(params.get("contains")),
+            offset=(page - 1) * page_size,
+            limit=page_size,
+        )
+        return Response({"count": count, "results": names})
 
     def retrieve(self, request, pk=None):
-        pkgs = spack.get_package_list()
-        if pk in pkgs:
-            return Response(spack.get_package_info([pk]))
+        info = spack.get_package_info([pk])
+        if info:
+            return Response(info)
         return Response("Package Not Found", status=404)
 
 
@@ -375,35 +405,11 @@ class BackendCustomAppInstall(LoginRequiredMixin, generic.View):
         app.save()
         cluster_id = app.cluster.id
 
-        def response(message):
-            if message.get("cluster_id") != cluster_id:
-                logger.error(
-                    "Cluster ID mismatch to callback: expected %s, received %s",
-                    pk,
-                    message.get("cluster_id"),
-                )
-            if message.get("app_id") != pk:
-                logger.error(
-                    "Application ID mismatch to callback:  expected %s, "
-                    "received %s",
-                    pk,
-                    message.get("app_id"),
-                )
-
-            if "log_message" in message:
-                logger.info("Install log message:  %s", message["log_message"])
-
-            app = Application.objects.get(pk=pk)
-            app.status = message["status"]
-            if message["status"] == "r":
-                # TODO App was installed.  Should have more attributes to set
-                pass
-            app.save()
-
         c2.send_command(
             cluster_id,
             "INSTALL_APPLICATION",
-            on_response=response,
+            on_response="INSTALL_APPLICATION",
+            response_args={"cluster_id": cluster_id, "app_id": pk},
             data={
                 "app_id": app.id,
                 "name": app.name,
@@ -428,40 +434,11 @@ class BackendSpackInstall(LoginRequiredMixin, generic.View):
         app.save()
         cluster_id = app.cluster.id
 
-        def response(message):
-            if message.get("cluster_id") != cluster_id:
-                logger.error(
-                    "Cluster ID mismatch versus callback: expected %s, "
-                    "received %s",
-                    pk,
-                    message.get("cluster_id"),
-                )
-            if message.get("app_id") != pk:
-                logger.error(
-                    "Application ID mismatch versus callback: expected %s, "
-                    "received %s",
-                    pk,
-                    message.get("app_id"),
-                )
-
-            if "log_message" in message:
-                logger.info("Install log message: %s", message["log_message"])
-
-            app = Application.objects.get(pk=pk)
-            app.status = message["status"]
-            if message["status"] == "r":
-                # App was installed.  Should have more attributes to set
-                app.spack_hash = message.get("spack_hash", "")
-                app.load_command = message.get("load_command", "")
-                app.installed_architecture = message.get("spack_arch", "")
-                app.compiler = message.get("compiler", "")
-                app.mpi = message.get("mpi", "")
-            app.save()
-
         c2.send_command(
             cluster_id,
             "SPACK_INSTALL",
-            on_response=response,
+            on_response="SPACK_INSTALL",
+            response_args={"cluster_id": cluster_id, "app_id": pk},
             data={
                 "app_id": app.id,
                 "name": app.spack_name,
@@ -13,7 +13,6 @@
 # limitations under the License.
 """ asyncviews.py """
 import asyncio
-import functools
 import logging
 
 from asgiref.sync import sync_to_async
@@ -23,9 +22,9 @@ from django.views import generic
 from rest_framework import viewsets
 from rest_framework.authentication import SessionAuthentication
 from rest_framework.authentication import TokenAuthentication
-from rest_framework.authtoken.models import Token
 from rest_framework.permissions import IsAuthenticated
 
+from .. import provisioner
 from ..models import Cluster, Role, Task
 from ..serializers import TaskSerializer
 
@@ -39,20 +38,15 @@ class RunningTasksViewSet(viewsets.ModelViewSet):
     authentication_classes = [SessionAuthentication, TokenAuthentication]
 
 
-def _consume_task(record, task):
-    logger.info("Task %s complete.", task.get_name(), exc_info=task.exception())
-    if record:
-        logger.info(
-            "    destroying task record %d-%s.  Data: %s",
-            record.id,
-            record.title,
-            record.data
-        )
-        asyncio.create_task(sync_to_async(record.delete)())
+class BackendAsyncView(generic.View):
+    """Template class for backend async operations
 
+    Subclasses implement `cmd(task_id, token, *args)`, which is queued by
+    `create_task()` and run by the provisioner (see `ghpcfe.provisioner`).
+    """
 
-class BackendAsyncView(generic.View):
-    """Template class for backend async operations"""
+    # Queued tasks with higher priority run first
+    priority = 0
 
     @classonlymethod
     def as_view(cls, **initkwargs):
@@ -72,16 +66,15 @@ class BackendAsyncView(generic.View):
             raise exceptions.PermissionDenied
 
     @sync_to_async
-    def make_task_record(self, user, title):
-        task_data = self.get_task_record_data(self.request)
-        t = Task.objects.create(owner=user, title=title, data=task_data)
-        t.save()
-        return t
-
-    @sync_to_async
-    def get_user_token(self, user):
-        token = Token.objects.get(user=user)
-        return token.key
+    def make_task_record(self, user, title, args):
+        return provisioner.enqueue(
+            type(self),
+            user,
+            title,
+            args,
+            data=self.get_task_record_data(self.request),
+            priority=self.priority,
+        )
 
     @sync_to_async
     def set_cluster_status_async(self, cluster_id, status):
@@ -96,13 +89,6 @@ class BackendAsyncView(generic.View):
         """Called from a syncronous context"""
         return {}
 
-    async def _cmd(self, *args, **kwargs):
-        await sync_to_async(self.cmd, thread_sensitive=False)(*args, **kwargs)
-
-    async def create_task(self, title, *args, **kwargs):
+    async def create_task(self, title, *args):
         logger.info("Creating task %s", title)
-        token = await self.get_user_token(self.request.user)
-        record = await self.make_task_record(self.request.user, title=title)
-        task = asyncio.create_task(self._cmd(record.pk, token, *args, **kwargs))
-        task.add_done_callback(functools.partial(_consume_task, record))
-        return record
+        return await self.make_task_record(self.request.user, title, args)
@@ -15,7 +15,10 @@
 """ clusters.py """
 
 import csv
+import itertools
 import json
+import zlib
+from decimal import Decimal
 from asgiref.sync import sync_to_async
 from rest_framework import viewsets
 from rest_framework.authentication import (
@@ -32,12 +35,14 @@ from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.views import redirect_to_login
 from django.core.exceptions import ValidationError
 from django.http import (
-    HttpResponse,
+    HttpResponseBadRequest,
     HttpResponseRedirect,
     JsonResponse,
     HttpResponseNotFound,
+    StreamingHttpResponse,
 )
 from django.urls import reverse
+from django.utils.dateparse import parse_date
 from django.forms import inlineformset_factory
 from django.views import generic
 from django.views.generic.edit import CreateView, UpdateView, DeleteView
@@ -59,9 +64,10 @@ from ..models import (
 )
 from ..serializers import ClusterSerializer
 from ..forms import ClusterForm, ClusterMountPointForm, ClusterPartitionForm
-from ..cluster_manager import cloud_info, c2, utils
+from ..cluster_manager import cloud_info, c2, heartbeat, progress, utils
 from ..cluster_manager.clusterinfo import ClusterInfo
 from ..views.asyncview import BackendAsyncView
+from ..permissions import SuperUserRequiredMixin
 
 from .view_utils import TerraformLogFile, GCSFile, StreamingFileView
 
@@ -561,25 +567,21 @@ class ClusterCostView(LoginRequiredMixin, generic.DetailView):
         context = super().get_context_data(**kwargs)
         context["navtab"] = "cluster"
 
-        cluster_users = []
-        for user in User.objects.all():
-            spend = user.total_spend(cluster_id=context["cluster"].id)
-            if spend > 0:
-                cluster_users.append(
-                    (
-                        spend,
-                        user.total_jobs(cluster_id=context["cluster"].id),
-                        user,
-                    )
-                )
+        cluster = context["cluster"]
+        user_spend = [x for x in cluster.spend_by_user() if x["spend"] > 0]
+        users = User.objects.in_bulk([x["user"] for x in user_spend])
+        context["users_by_spend"] = [
+            (x["spend"], x["jobs"], users[x["user"]]) for x in user_spend
+        ]
 
+        app_spend = {
+            x["application"]: x for x in cluster.spend_by_application()
+        }
         cluster_apps = []
-        for app in Application.objects.filter(cluster=context["cluster"].id):
-            cluster_apps.append((app.total_spend(), app))
+        for app in Application.objects.filter(cluster=cluster.id):
+            spend = app_spend.get(app.id, {"spend": Decimal(0), "jobs": 0})
+            cluster_apps.append((spend["spend"], spend["jobs"], app))
 
-        context["users_by_spend"] = sorted(
-            cluster_users, key=lambda x: x[0], reverse=True
-        )
         context["apps_by_spend"] = sorted(
             cluster_apps, key=lambda x: x[0], reverse=True
         )
@@ -661,25 +663,108 @@ class ClusterLogView(LoginRequiredMixin, generic.DetailView):
         return context
 
 
+class _Echo:
+    """File-like object that returns what is written to it, so csv.writer
+    output can be streamed"""
+
+    def write(self, value):
+        return value
+
+
 class ClusterCostExportView(LoginRequiredMixin, generic.DetailView):
-    """Export raw cost data per cluster as CSV"""
+    """Export raw cost data per cluster as CSV
+
+    Rows are streamed from the database in chunks, so exports of long job
+    histories don't have to be held in memory.  Supports GET parameters:
+        start, end: Only include jobs submitted within these dates
+                    (YYYY-MM-DD, inclusive)
+        user:       Only include jobs of this username
+        gzip:       If set, compress the CSV with gzip
+    """
 
     model = Cluster
+    chunk_size = 2000
+
+    columns = [
+        ("Job ID", "id"),
+        ("User", "user__username"),
+        ("Application", "application__name"),
+        ("Partition", "partition__name"),
+        ("Number of Nodes", "number_of_nodes"),
+        ("Ranks per Node", "ranks_per_node"),
+        ("Runtime (sec)", "runtime"),
+        ("Node Price (per hour)", "node_price"),
+        ("Job Cost", "job_cost"),
+        ("Submission Time", "date_time_submission"),
+    ]
+
+    def get_jobs(self):
+        jobs = Job.objects.filter(cluster=self.object.id)
+
+        for (param, lookup) in (
+            ("start", "date_time_submission__date__gte"),
+            ("end", "date_time_submission__date__lte"),
+        ):
+            value = self.request.GET.get(param)
+            if value:
+                date = parse_date(value)
+                if not date:
+                    raise ValidationError(f"Invalid {param} date '{value}'")
+                jobs = jobs.filter(**{lookup: date})
+
+        if self.request.GET.get("user"):
+            jobs = jobs.filter(user__username=self.request.GET["user"])
+
+        return jobs.order_by("id").values_list(*[x[1] for x in self.columns])
+
+    async def _rows(self, jobs):
+        # Under ASGI, a sync iterator would be read into a list before
+        # anything is sent - so fetch each chunk of rows in a thread
+        writer = csv.writer(_Echo())
+        yield writer.writerow([x[0] for x in self.columns])
+        rows = jobs.iterator(chunk_size=self.chunk_size)
+        fetch = sync_to_async(
+            lambda: list(itertools.islice(rows, self.chunk_size))
+        )
+        while True:
+            chunk = await fetch()
+            if not chunk:
+                break
+            yield "".join(writer.writerow(job) for job in chunk)
+
+    async def _gzip(self, rows):
+        compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+        buf = []
+        buf_len = 0
+        async for row in rows:
+            buf.append(row.encode("utf-8"))
+            buf_len += len(buf[-1])
+            # Compress in blocks, rather than row by row
+            if buf_len > 64 * 1024:
+                yield compressor.compress(b"".join(buf))
+                buf = []
+                buf_len = 0
+        yield compressor.compress(b"".join(buf)) + compressor.flush()
 
     def get(self, request, *args, **kwargs):
-        response = HttpResponse(content_type="text/csv")
-        writer = csv.writer(response)
-        writer.writerow(["Job ID", "User", "Application", "Partition",
-                         "Number of Nodes", "Ranks per Node", "Runtime (sec)",
-                         "Node Price (per hour)", "Job Cost"])
-
-        for job in Job.objects.filter(
-                cluster=self.kwargs["pk"]).values_list("id", "user__username",
-                "application__name", "partition__name", "number_of_nodes",
-                "ranks_per_node", "runtime", "node_price", "job_cost"):
-            writer.writerow(job)
-
-        response["Content-Disposition"] = "attachment; filename='report.csv'"
+        self.object = self.get_object()
+        try:
+            jobs = self.get_jobs()
+        except ValidationError as err:
+            return HttpResponseBadRequest(err.message)
+
+        filename = f"{self.object.name}-cost.csv"
+        if request.GET.get("gzip"):
+            response = StreamingHttpResponse(
+                self._gzip(self._rows(jobs)), content_type="application/gzip"
+            )
+            filename += ".gz"
+        else:
+            response = StreamingHttpResponse(
+                self._rows(jobs), content_type="text/csv"
+            )
+
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
         return response
 
 
@@ -723,6 +808,37 @@ class ClusterViewSet(viewsets.ModelViewSet):
             ]
         )
 
+    @action(methods=["get"], detail=False, permission_classes=[IsAuthenticated])
+    def get_heartbeats(self, request):
+        """C2 liveness of each live cluster visible to the user"""
+        cluster_ids = self.get_queryset().values_list("id", flat=True)
+        return Response(heartbeat.get_heartbeats(cluster_ids))
+
+    @action(methods=["get"], detail=True, permission_classes=[IsAuthenticated])
+    def get_heartbeat(self, request, pk=None):
+        """C2 liveness of the cluster"""
+        cluster = self.get_object()
+        heartbeats = heartbeat.get_heartbeats([cluster.id])
+        if not heartbeats:
+            return Response({"cluster_id": cluster.id, "health": None})
+        return Response(heartbeats[0])
+
+    @action(methods=["get"], detail=True, permission_classes=[IsAuthenticated])
+    def get_progress(self, request, pk=None):
+        """Progress of the cluster's latest ghpc or Terraform command"""
+        cluster_info = ClusterInfo(self.get_object())
+        reports = [
+            report
+            for report in (
+                progress.read_progress(cluster_info.cluster_dir),
+                progress.read_progress(cluster_info.get_terraform_dir()),
+            )
+            if report
+        ]
+        if not reports:
+            return Response({})
+        return Response(max(reports, key=lambda report: report["updated"]))
+
     @action(
         methods=["get"],
         detail=True,
@@ -887,12 +1003,13 @@ class BackendCreateCluster(BackendAsyncView):
     @sync_to_async
     def get_orm(self, cluster_id):
         cluster = Cluster.objects.get(pk=cluster_id)
-        creds = cluster.cloud_credential.detail
-        return (cluster, creds)
+        # The credential is stored by reference - its secret is not copied
+        # into the task
+        return (cluster, cluster.cloud_credential)
 
-    def cmd(self, unused_task_id, unused_token, cluster, creds):
+    def cmd(self, unused_task_id, unused_token, cluster, credential):
         ci = ClusterInfo(cluster)
-        ci.prepare(creds)
+        ci.prepare(credential.detail)
 
     async def get(self, request, pk):
         """this will invoke the background tasks and return immediately"""
@@ -963,6 +1080,9 @@ class BackendStartCluster(BackendAsyncView):
 class BackendDestroyCluster(BackendAsyncView):
     """A view to make async call to create a new cluster"""
 
+    # Free cloud resources ahead of creating more
+    priority = 10
+
     @sync_to_async
     def get_orm(self, cluster_id):
         cluster = Cluster.objects.get(pk=cluster_id)
@@ -990,30 +1110,57 @@ class BackendSyncCluster(LoginRequiredMixin, generic.View):
     """Backend handler for cluster syncing"""
 
     def get(self, request, pk, *args, **kwargs):
-        def response(message):
-            logger.info("Received SYNC Complete: %s", message)
-            if message.get("cluster_id") != pk:
-                logger.error(
-                    "Cluster ID mismatch versus to callback: "
-                    "expected %s, %s",
-                    pk,
-                    message.get("cluster_id"),
-                )
-            cluster = Cluster.objects.get(pk=pk)
-            cluster.status = message.get("status", "r")
-            cluster.save()
-            return True
-
         cluster = get_object_or_404(Cluster, pk=pk)
         cluster.status = "i"
         cluster.save()
-        c2.send_command(pk, "SYNC", data={}, on_response=response)
+        c2.send_command(
+            pk,
+            "SYNC",
+            data={},
+            on_response="SYNC",
+            response_args={"cluster_id": pk},
+        )
 
         return HttpResponseRedirect(
             reverse("cluster-detail", kwargs={"pk": pk})
         )
 
 
+class BackendSyncAllClusters(SuperUserRequiredMixin, generic.View):
+    """Backend handler to sync every ready cluster in one fan-out"""
+
+    def get(self, request, *args, **kwargs):
+        clusters = Cluster.objects.filter(status="r")
+        cluster_ids = list(clusters.values_list("id", flat=True))
+        clusters.update(status="i")
+        fanout_id = c2.send_command_to_clusters(
+            cluster_ids, "SYNC", data={}, on_response="SYNC"
+        )
+        return JsonResponse(
+            {
+                "fanout_id": fanout_id,
+                "url": reverse("backend-c2-fanout", kwargs={"pk": fanout_id}),
+            }
+        )
+
+
+class BackendFanOutResults(SuperUserRequiredMixin, generic.View):
+    """Backend handler reporting the responses to a fan-out command"""
+
+    def get(self, request, pk, *args, **kwargs):
+        results = c2.get_fanout_results(pk)
+        if results is None:
+            return HttpResponseNotFound()
+        return JsonResponse(results)
+
+
+class BackendC2PublishStats(SuperUserRequiredMixin, generic.View):
+    """Backend handler reporting the Frontend's C2 message publishing"""
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(c2.get_publish_stats())
+
+
 class BackendAuthUserGCP(BackendAsyncView):
     """Backend handler to authorise GCP users on the cluster"""
 
@@ -1085,31 +1232,14 @@ class BackendAuthUserGCP2(LoginRequiredMixin, generic.View):
         cluster_name = cluster.name
         task_id = task.id
 
-        def callback(message):
-            logger.info(
-                "GCS Auth Status message received from cluster %s: %s",
-                cluster_name,
-                message["status"],
-            )
-            task = Task.objects.get(pk=task_id)
-            task.data.update(message)
-            task.save()
-            if "exit_status" in message:
-                logger.info(
-                    "Final result from cluster %s for user auth to GCS was "
-                    "status code %s",
-                    cluster_name,
-                    message["exit_status"],
-                )
-                task.delete()
-
         message_data = {
             "login_uid": user_uid,
         }
         comm_id = c2.send_command(
             cluster_id,
             "REGISTER_USER_GCS",
-            on_response=callback,
+            on_response="REGISTER_USER_GCS",
+            response_args={"cluster_name": cluster_name, "task_id": task_id},
             data=message_data,
         )
         task.data["comm_id"] = comm_id
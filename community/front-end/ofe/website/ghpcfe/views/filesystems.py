@@ -271,6 +271,9 @@ class FilesystemTFLogView(StreamingFileView):
 class BackendDestroyFilesystem(BackendAsyncView):
     """A view to make async call to destroy a filesystem"""
 
+    # Free cloud resources ahead of creating more
+    priority = 10
+
     @sync_to_async
     def get_orm(self, fs_id):
         fs = Filesystem.objects.get(pk=fs_id)
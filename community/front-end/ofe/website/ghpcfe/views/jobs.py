@@ -19,6 +19,7 @@ from rest_framework import viewsets
 from rest_framework.permissions import IsAuthenticated
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib import messages
+from django.db import transaction
 from django.http import HttpResponseRedirect
 from django.urls import reverse, reverse_lazy
 from django.views import generic
@@ -175,22 +176,18 @@ class JobCreateView2(LoginRequiredMixin, generic.CreateView):
                 None, "Error: Cannot submit job. User quota disabled"
             )
             return self.form_invalid(form)
-        if self.object.user.quota_type == "l":
-            quota_remaining = (
-                self.object.user.quota_amount - self.object.user.total_spend()
-            )
-            # Fudge to nearest cent to avoid "apparently equal" issues in user
-            # display
-            if self.object.job_cost > (quota_remaining - Decimal(0.005)):
+        # Charge the quota and create the job together, so neither happens
+        # without the other
+        with transaction.atomic():
+            if not self.object.user.charge_quota_for_job(self.object):
                 form.add_error(
                     None,
                     "Error: Insufficient quota remaining (have "
-                    f"${quota_remaining:0.2f}, job would require "
-                    f"${self.object.job_cost:0.2f})",
+                    f"${self.object.user.quota_remaining():0.2f}, job would "
+                    f"require ${self.object.job_cost:0.2f})",
                 )
                 return self.form_invalid(form)
-
-        self.object.save()
+            self.object.save()
         return HttpResponseRedirect(self.get_success_url())
 
     def get_initial(self):
@@ -271,22 +268,18 @@ class JobRerunView(LoginRequiredMixin, generic.CreateView):
                 None, "Error: Cannot submit job. User quota disabled"
             )
             return self.form_invalid(form)
-        if self.object.user.quota_type == "l":
-            quota_remaining = (
-                self.object.user.quota_amount - self.object.user.total_spend()
-            )
-            # Fudge to nearest cent to avoid "apparently equal" issues in user
-            # display
-            if self.object.job_cost > (quota_remaining - Decimal(0.005)):
+        # Charge the quota and create the job together, so neither happens
+        # without the other
+        with transaction.atomic():
+            if not self.object.user.charge_quota_for_job(self.object):
                 form.add_error(
                     None,
                     "Error: Insufficient quota remaining (have "
-                    f"${quota_remaining:0.2f}, job would require "
-                    f"${self.object.job_cost:0.2f})",
+                    f"${self.object.user.quota_remaining():0.2f}, job would "
+                    f"require ${self.object.job_cost:0.2f})",
                 )
                 return self.form_invalid(form)
-
-        self.object.save()
+            self.object.save()
         return HttpResponseRedirect(self.get_success_url())
 
     def get_initial(self):
@@ -444,43 +437,6 @@ class BackendJobRun(LoginRequiredMixin, generic.View):
                     reverse("job-detail", kwargs={"pk": pk})
                 )
 
-        def response(message):
-            if message.get("cluster_id") != cluster_id:
-                logger.error(
-                    "Cluster ID mismatch versus callback: expected %s, "
-                    "received %s",
-                    pk,
-                    message.get("cluster_id"),
-                )
-            if message.get("job_id") != pk:
-                logger.error(
-                    "Job ID mismatch versus callback:  expected %s, "
-                    "received %s",
-                    pk,
-                    message.get("job_id"),
-                )
-
-            job = Job.objects.get(pk=pk)
-            job.status = message["status"]
-            logger.info(
-                "Processing job message, id %d, status %s", pk, job.status
-            )
-
-            if "slurm_job_id" in message and not job.slurm_jobid:
-                job.slurm_jobid = message["slurm_job_id"]
-
-            if job.status in ["c", "e"]:
-                job.runtime = message.get("job_runtime", None)
-                job.result_unit = message.get("result_unit", "")
-                job.result_value = message.get("result_value", None)
-                job.job_cost = (
-                    job.number_of_nodes
-                    * job.runtime
-                    / Decimal(3600)
-                    * job.node_price
-                )
-            job.save()
-
         # N.B not base64 encoding the job script because the pubsub library uses
         # protobuf anyway
         message_data = {
@@ -506,7 +462,11 @@ class BackendJobRun(LoginRequiredMixin, generic.View):
             message_data["gpus_per_node"] = job.partition.GPU_per_node
 
         c2.send_command(
-            cluster_id, "RUN_JOB", on_response=response, data=message_data
+            cluster_id,
+            "RUN_JOB",
+            on_response="RUN_JOB",
+            response_args={"cluster_id": cluster_id, "job_id": pk},
+            data=message_data,
         )
         messages.success(request, "Job sent to Cluster")
         return HttpResponseRedirect(reverse("job-detail", kwargs={"pk": pk}))
@@ -44,7 +44,6 @@ from ..cluster_manager.vpc import (
 from ..views.asyncview import BackendAsyncView
 from ..serializers import VirtualNetworkSerializer, VirtualSubnetSerializer
 from ..permissions import SuperUserRequiredMixin
-from collections import defaultdict
 import json
 
 import logging
@@ -203,12 +202,14 @@ class VPCImportView2(SuperUserRequiredMixin, CreateView):
 
     def _setup_data(self, cred_id):
         self.cloud_credential = get_object_or_404(Credential, pk=cred_id)
-        self.subnet_info = cloud_info.get_subnets(
+        inventory = cloud_info.get_subnet_inventory(
             "GCP", self.cloud_credential.detail
         )
-        self.vpc_sub_map = defaultdict(list)
-        for (vpc, region, subnet, cidr) in self.subnet_info:
-            self.vpc_sub_map[vpc].append((subnet, region, cidr))
+        self.subnet_info = inventory.subnets
+        self.vpc_sub_map = {
+            vpc: [(subnet, region, cidr) for (_, region, subnet, cidr) in x]
+            for (vpc, x) in inventory.by_vpc.items()
+        }
 
     def get(self, request, *args, **kwargs):
         self._setup_data(kwargs["credential"])
@@ -263,24 +264,26 @@ class VPCUpdateView(SuperUserRequiredMixin, UpdateView):
     template_name = "vpc/update_form.html"
     form_class = VPCForm
 
+    def _get_vpc_subnets(self, vpc):
+        """Returns the usable subnets of the VPC, fetched once per request"""
+        if not hasattr(self, "_vpc_subnets"):
+            self._vpc_subnets = cloud_info.get_subnet_inventory(
+                "GCP", vpc.cloud_credential.detail
+            ).by_vpc[vpc.cloud_id]
+        return self._vpc_subnets
+
     def get_initial(self):
+        vpc = self.get_object()
         initial = {
             "regions": cloud_info.get_region_zone_info(
-                "GCP", self.get_object().cloud_credential.detail
+                "GCP", vpc.cloud_credential.detail
             ).keys()
         }
-        if self.get_object().cloud_state == "i":
-            subnet_info = cloud_info.get_subnets(
-                "GCP", self.get_object().cloud_credential.detail
-            )
+        if vpc.cloud_state == "i":
             initial["available_subnets"] = [
-                (x[2], x[2])
-                for x in subnet_info
-                if x[0] == self.get_object().cloud_id
-            ]
-            initial["subnets"] = [
-                x.cloud_id for x in self.get_object().subnets.all()
+                (x[2], x[2]) for x in self._get_vpc_subnets(vpc)
             ]
+            initial["subnets"] = [x.cloud_id for x in vpc.subnets.all()]
         return initial
 
     def form_valid(self, form):
@@ -301,9 +304,7 @@ class VPCUpdateView(SuperUserRequiredMixin, UpdateView):
             )
             vs.save()
 
-        subnet_info = cloud_info.get_subnets(
-            "GCP", self.get_object().cloud_credential.detail
-        )
+        subnet_info = self._get_vpc_subnets(self.object)
         # Need list of subnets to delete - not selected, but are in DB
         for sn in self.object.subnets.all():
             if sn.cloud_id not in form_subnets:
@@ -321,7 +322,7 @@ class VPCUpdateView(SuperUserRequiredMixin, UpdateView):
                 logger.debug("Subnet %s not found in DB", sn)
                 # Need to find subnet info in 'subnet_info'
                 for subnet in subnet_info:
-                    if subnet[2] in form_subnets:
+                    if subnet[2] == sn:
                         logger.info(
                             "Adding new subnet %s from VPC %s",
                             subnet[2],
@@ -539,6 +540,9 @@ class BackendStartVPC(BackendAsyncView):
 class BackendDestroyVPC(BackendAsyncView):
     """A view to make async call to destroy a VirtualNetwork"""
 
+    # Free cloud resources ahead of creating more
+    priority = 10
+
     @sync_to_async
     def get_orm(self, vpc_id):
         vpc = VirtualNetwork.objects.get(pk=vpc_id)
@@ -561,11 +565,12 @@ class BackendDestroyVPC(BackendAsyncView):
                 destroy_vpc(vpc)
                 vpc.cloud_state = "xm"
                 vpc.save()
+            # Run by the provisioner, so there's no request to report to
             except Exception as err: # pylint: disable=broad-except
-                messages.add_message(
-                    self.request,
-                    messages.ERROR,
-                    f"Cannot destroy VPC - unexpected error ({err})",
+                logger.error(
+                    "Cannot destroy VPC %s - unexpected error",
+                    vpc.id,
+                    exc_info=err,
                 )
 
     async def get(self, request, pk):
@@ -319,12 +319,11 @@ class BackendCreateWorkbench(BackendAsyncView):
     @sync_to_async
     def get_orm(self, workbench_id):
         workbench = Workbench.objects.get(pk=workbench_id)
-        creds = workbench.cloud_credential.detail
-        return (workbench, creds)
+        return (workbench, workbench.cloud_credential)
 
-    def cmd(self, unused_task_id, unused_token, workbench, creds):
+    def cmd(self, unused_task_id, unused_token, workbench, credential):
 
-        WorkbenchInfo(workbench).create_workbench_dir(creds)
+        WorkbenchInfo(workbench).create_workbench_dir(credential.detail)
 
     async def get(self, request, pk):
         """this will invoke the background tasks and return immediately"""
@@ -369,6 +368,9 @@ class BackendStartWorkbench(BackendAsyncView):
 class BackendDestroyWorkbench(BackendAsyncView):
     """Backend handler for workbench teardown"""
 
+    # Free cloud resources ahead of creating more
+    priority = 10
+
     @sync_to_async
     def get_orm(self, workbench_id):
         workbench = Workbench.objects.get(pk=workbench_id)